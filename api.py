@@ -1,34 +1,73 @@
-import pandas as pd
-import numpy as np
+import os
+import re
 import json
 import logging
 import asyncio
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+import pandas as pd
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.responses import FileResponse, StreamingResponse
 
 # Import the compiled LangGraph app from your main agent script
 from main_agent import app
+from batch import DEFAULT_CONCURRENCY, append_checkpoint, load_checkpoint, parse_jsonl, run_batch, to_jsonl
+from encoder import ENCODE_MAX_ROWS, to_sse
+from result_handle import ResultHandle
+from executors import THREAD_POOL_SIZE, get_process_pool, get_thread_pool, monitor_event_loop_lag, run_in_process, run_in_thread, shutdown_executors
+from value_index import get_value_index
+import metrics
+
+# Graph nodes of /batch share the default executor (CPU_THREAD_POOL_SIZE threads)
+# with /stream-agent, so a batch may only use part of it.
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", str(max(1, THREAD_POOL_SIZE // 2))))
 
-# --- 1. Custom JSON Encoder ---
-# This class teaches Python's JSON library how to handle special types
-# that it doesn't know about, like NumPy numbers and Pandas DataFrames.
-class CustomJSONEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, (np.integer, np.int64)):
-            return int(obj)
-        if isinstance(obj, (np.floating, np.float64)):
-            return float(obj)
-        if isinstance(obj, pd.DataFrame):
-            # Convert DataFrame to a JSON-friendly dict with 'split' orientation
-            return obj.to_dict(orient='split')
-        # Let the base class default method raise the TypeError
-        return super(CustomJSONEncoder, self).default(obj)
+# Payloads carrying at least this many DataFrame rows are JSON-encoded in a worker process.
+ENCODE_OFFLOAD_ROWS = int(os.getenv("ENCODE_OFFLOAD_ROWS", "2000"))
 
 # --- API Setup ---
-api = FastAPI()
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    # LangGraph runs sync nodes (Firestore reads, pandas, formatting) on the
+    # loop's default executor, so make that our sized CPU thread pool.
+    asyncio.get_running_loop().set_default_executor(get_thread_pool())
+    # Start the encoding workers before anything opens a Firestore (gRPC) client.
+    get_process_pool().submit(int).result()
+    # Load the value index before serving so no request pays for it.
+    await run_in_thread(get_value_index)
+    lag_monitor = asyncio.create_task(monitor_event_loop_lag())
+    yield
+    lag_monitor.cancel()
+    shutdown_executors()
+
+api = FastAPI(lifespan=lifespan)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
 
+def _encoded_rows(value) -> int:
+    if isinstance(value, ResultHandle):
+        return min(len(value), ENCODE_MAX_ROWS)
+    return len(value) if isinstance(value, pd.DataFrame) else 0
+
+
+def _frame_rows(payload: dict) -> int:
+    """Counts the result rows that will be encoded for a payload and the dicts directly inside it."""
+    rows = 0
+    for value in payload.values():
+        if isinstance(value, dict):
+            rows += sum(_encoded_rows(v) for v in value.values())
+        else:
+            rows += _encoded_rows(value)
+    return rows
+
+
+async def _encode(encode, payload: dict) -> str:
+    """Encodes small payloads inline and large ones in the process pool, off the event loop."""
+    if _frame_rows(payload) >= ENCODE_OFFLOAD_ROWS:
+        metrics.increment("encode_offloaded_total")
+        return await run_in_process(encode, payload)
+    return encode(payload)
+
+
 # --- API Endpoints ---
 
 @api.get("/stream-agent")
@@ -41,13 +80,26 @@ async def stream_agent_endpoint(question: str):
     async def event_stream():
         """The generator function that yields events as the agent runs."""
         try:
-            # Use 'astream' to get real-time updates from the LangGraph
-            async for chunk in app.astream(inputs):
+            # Use 'astream' to get real-time updates from the LangGraph. 'updates'
+            # carries each node's output; 'custom' carries row chunks written
+            # by the execution node while the Firestore stream is open.
+            streamed_rows = 0
+            async for mode, chunk in app.astream(inputs, stream_mode=["updates", "custom"]):
+                if mode == "custom":
+                    if "rows_chunk" in chunk:
+                        streamed_rows += len(chunk["rows_chunk"]["data"])
+                        yield await _encode(to_sse, {"event": "rows_chunk", "data": chunk["rows_chunk"]})
+                    continue
                 # Each chunk is a dictionary where the key is the node that just ran
                 for node_name, node_output in chunk.items():
+                    if streamed_rows and "sql_dataframe" in node_output:
+                        # The client already has these rows; send the plan and row
+                        # count only. The full result stays in the graph state.
+                        node_output = {k: v for k, v in node_output.items() if k != "sql_dataframe"}
+                        node_output.update(row_count=streamed_rows, rows_streamed=True)
                     event_data = {"event": node_name, "data": node_output}
                     # Yield the event in Server-Sent Event format, using our custom encoder
-                    yield f"data: {json.dumps(event_data, cls=CustomJSONEncoder)}\n\n"
+                    yield await _encode(to_sse, event_data)
                     await asyncio.sleep(0.1)
             
             # Send a final 'end' event
@@ -59,6 +111,45 @@ async def stream_agent_endpoint(question: str):
 
     return StreamingResponse(event_stream(), media_type="text/event-stream")
 
+@api.post("/batch")
+async def batch_endpoint(request: Request, concurrency: int = DEFAULT_CONCURRENCY, checkpoint: str | None = None):
+    """
+    Receives a JSONL body of questions and streams one JSONL result per question
+    as each completes. With a `checkpoint` name, results are also appended to a
+    server-side file and a rerun with the same name skips finished items.
+    `concurrency` is capped at BATCH_MAX_CONCURRENCY (half the CPU thread pool
+    by default) so a batch cannot take every thread interactive requests need.
+    """
+    body = (await request.body()).decode("utf-8")
+    try:
+        items = parse_jsonl(body.splitlines())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    checkpoint_path = None
+    skip_ids = set()
+    if checkpoint:
+        if not re.fullmatch(r"[A-Za-z0-9_-]+", checkpoint):
+            raise HTTPException(status_code=400, detail="Checkpoint name may only contain letters, digits, '_' and '-'.")
+        checkpoint_dir = os.getenv("BATCH_CHECKPOINT_DIR", "batch_checkpoints")
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        checkpoint_path = os.path.join(checkpoint_dir, f"{checkpoint}.jsonl")
+        skip_ids = load_checkpoint(checkpoint_path)
+
+    async def result_stream():
+        async for record in run_batch(app, items, concurrency=min(max(1, concurrency), BATCH_MAX_CONCURRENCY), skip_ids=skip_ids):
+            line = await _encode(to_jsonl, record)
+            if checkpoint_path:
+                append_checkpoint(checkpoint_path, line)
+            yield line
+
+    return StreamingResponse(result_stream(), media_type="application/x-ndjson")
+
+@api.get("/metrics")
+async def metrics_endpoint():
+    """Returns in-process metrics, including event-loop lag percentiles."""
+    return metrics.snapshot()
+
 @api.get("/")
 async def read_index():
     """Serves the main index.html file at the root URL."""
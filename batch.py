@@ -0,0 +1,262 @@
+# batch.py
+#
+# Runs many questions through the LangGraph agent with bounded concurrency.
+#
+# Input is JSONL, one question per line:
+#   {"id": "q1", "question": "What are the top 5 regions by total contract cost?"}
+#
+# Output is JSONL, one result per line, written as each question completes.
+# The output file doubles as a checkpoint: rerunning with the same output
+# skips every id that already finished successfully.
+#
+# How to run:
+#   python batch.py questions.jsonl results.jsonl --concurrency 8
+
+import os
+import re
+import json
+import time
+import asyncio
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Iterable
+
+from langchain_core.runnables import RunnableConfig
+
+from encoder import CustomJSONEncoder
+
+# Default number of questions in flight at once. Raise it until the LLM quota is hit.
+DEFAULT_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+
+
+# --- 1. Shared Result Cache ---
+class BatchCache:
+    """
+    Deduplicates work shared between questions in one batch.
+
+    Identical questions are already collapsed by run_batch, so the cache
+    works one level down: query results are keyed by the canonical JSON of
+    the plan, and two differently worded questions that produce the same
+    plan only hit Firestore once. Concurrent requests for
+    the same key wait on the first one instead of recomputing. Cached query
+    results are ResultHandles, so they count against RESULT_MEMORY_BUDGET_MB
+    and spill to disk like any other result; every run sharing one only
+    reads from it.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+        self._pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_compute(self, key: str, compute: Callable):
+        with self._lock:
+            if key in self._values:
+                self.hits += 1
+                return self._values[key]
+            event = self._pending.get(key)
+            if event is None:
+                event = self._pending[key] = threading.Event()
+                owner = True
+                self.misses += 1
+            else:
+                owner = False
+
+        if not owner:
+            event.wait()
+            with self._lock:
+                if key in self._values:
+                    self.hits += 1
+                    return self._values[key]
+            # The owner failed; compute our own copy rather than propagating its error.
+            return compute()
+
+        try:
+            value = compute()
+            with self._lock:
+                self._values[key] = value
+            return value
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+            event.set()
+
+    def result(self, query_plan: dict, compute: Callable) -> dict:
+        return self.get_or_compute("result:" + json.dumps(query_plan, sort_keys=True, default=str), compute)
+
+
+def get_batch_cache(config: RunnableConfig | None) -> BatchCache | None:
+    """Returns the BatchCache threaded through the graph config, if any."""
+    if not config:
+        return None
+    return config.get("configurable", {}).get("batch_cache")
+
+
+def normalize_question(question: str) -> str:
+    """Lowercases and collapses whitespace/punctuation so trivially different duplicates match."""
+    return re.sub(r"[\W_]+", " ", question.lower()).strip()
+
+
+# --- 2. JSONL Input and Checkpoints ---
+def parse_jsonl(lines: Iterable[str]) -> list[dict]:
+    """Parses question lines, defaulting the id to the 1-based line number."""
+    items = []
+    for line_no, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Line {line_no} is not valid JSON: {e}")
+        if isinstance(record, str):
+            record = {"question": record}
+        if not isinstance(record, dict):
+            raise ValueError(f"Line {line_no} must be a JSON object or string, not {type(record).__name__}.")
+        if not record.get("question"):
+            raise ValueError(f"Line {line_no} is missing the 'question' field.")
+        items.append({"id": str(record.get("id", line_no)), "question": record["question"]})
+    return items
+
+
+def load_checkpoint(path: str) -> set[str]:
+    """Returns the ids that already completed successfully in a previous run."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A run killed mid-write leaves a truncated last line; that item just reruns.
+                continue
+            if record.get("status") == "ok":
+                done.add(str(record.get("id")))
+    return done
+
+
+def append_checkpoint(path: str, line: str):
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(line)
+        f.flush()
+
+
+def to_jsonl(record: dict) -> str:
+    return json.dumps(record, cls=CustomJSONEncoder) + "\n"
+
+
+# --- 3. Batch Runner ---
+def _build_record(item: dict, final_state: dict, elapsed: float) -> dict:
+    error = final_state.get("error")
+    return {
+        "id": item["id"],
+        "question": item["question"],
+        "status": "error" if error else "ok",
+        "error": error,
+        "firestore_query_plan": final_state.get("firestore_query_plan"),
+        "data": final_state.get("sql_dataframe"),
+        "visualization": final_state.get("visualization"),
+        "formatted_data_for_visualization": final_state.get("formatted_data_for_visualization"),
+        "insight": final_state.get("insight"),
+        "elapsed_s": round(elapsed, 3),
+    }
+
+
+async def run_batch(
+    graph,
+    items: list[dict],
+    concurrency: int = DEFAULT_CONCURRENCY,
+    skip_ids: set[str] | None = None,
+) -> AsyncIterator[dict]:
+    """
+    Runs every item through the graph with at most `concurrency` questions in
+    flight and yields one result record per item as soon as it completes.
+    Items whose id is in `skip_ids` are not run. Duplicate questions are run
+    once and their result is fanned out to every id that asked it.
+    """
+    skip_ids = skip_ids or set()
+    pending = [item for item in items if item["id"] not in skip_ids]
+    if len(pending) < len(items):
+        logging.info(f"Skipping {len(items) - len(pending)} items already completed in the checkpoint.")
+
+    groups = {}
+    for item in pending:
+        groups.setdefault(normalize_question(item["question"]), []).append(item)
+
+    cache = BatchCache()
+    config = {"configurable": {"batch_cache": cache}}
+    queue = asyncio.Queue()
+    work = asyncio.Queue()
+    for group in groups.values():
+        work.put_nowait(group)
+
+    async def worker():
+        while True:
+            try:
+                group = work.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            start = time.perf_counter()
+            try:
+                final_state = await graph.ainvoke({"question": group[0]["question"]}, config=config)
+            except Exception as e:
+                logging.error(f"Batch item '{group[0]['id']}' failed: {e}")
+                final_state = {"error": str(e)}
+            elapsed = time.perf_counter() - start
+            for item in group:
+                await queue.put(_build_record(item, final_state, elapsed))
+
+    workers = [asyncio.create_task(worker()) for _ in range(max(1, min(concurrency, len(groups))))]
+
+    async def close_when_done():
+        await asyncio.gather(*workers)
+        await queue.put(None)
+
+    closer = asyncio.create_task(close_when_done())
+    try:
+        while True:
+            record = await queue.get()
+            if record is None:
+                break
+            yield record
+    finally:
+        for task in workers:
+            task.cancel()
+        closer.cancel()
+        logging.info(f"Batch finished. Shared cache hits: {cache.hits}, misses: {cache.misses}.")
+
+
+# --- 4. Command-Line Entry Point ---
+async def _run_cli(input_path: str, output_path: str, concurrency: int):
+    # Sync graph nodes run on the loop's default executor, so size it to match
+    # the requested concurrency or it becomes the real bottleneck.
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+
+    from main_agent import app
+
+    with open(input_path, encoding="utf-8") as f:
+        items = parse_jsonl(f)
+    done = load_checkpoint(output_path)
+
+    completed = 0
+    async for record in run_batch(app, items, concurrency=concurrency, skip_ids=done):
+        append_checkpoint(output_path, to_jsonl(record))
+        completed += 1
+        logging.info(f"[{completed}] {record['id']}: {record['status']} in {record['elapsed_s']}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a JSONL file of questions through the FloodGPT agent.")
+    parser.add_argument("input", help="JSONL file with one {\"id\", \"question\"} object per line.")
+    parser.add_argument("output", help="JSONL file to append results to. Also used as the resume checkpoint.")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="Questions to run at once.")
+    args = parser.parse_args()
+    asyncio.run(_run_cli(args.input, args.output, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
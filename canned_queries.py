@@ -0,0 +1,220 @@
+# canned_queries.py
+#
+# Precompiled query plans for the questions users ask most, taken from the
+# curated analyses in src_data_loader/analyze_flood_control.ipynb and
+# rewritten for the Firestore schema. A keyword-and-slot matcher recognizes
+# these questions so they skip LLM planning. A question only matches when
+# every word in it is accounted for, either by the template or by a slot it
+# fills; anything else (a year, "lowest", a status, a place that did not
+# resolve) falls through to generate_firestore_query_plan.
+
+import re
+import copy
+import logging
+from dataclasses import dataclass, field
+from typing import Callable
+
+from query_validator import validate_query_plan
+from value_index import get_value_index
+
+DEFAULT_TOP_N = 10
+
+# Words that carry no meaning a template could get wrong.
+_FILLER = {
+    "a", "an", "the", "of", "by", "in", "for", "per", "each", "across", "all", "and", "with", "to", "on",
+    "what", "which", "who", "how", "is", "are", "was", "were", "do", "does", "did", "has", "have", "had",
+    "show", "me", "list", "give", "get", "find", "display", "see", "please", "can", "you", "i", "want",
+    "their", "its", "there", "they", "project", "projects", "flood", "control",
+}
+
+_NUMBER_WORDS = {
+    "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7,
+    "eight": 8, "nine": 9, "ten": 10, "fifteen": 15, "twenty": 20,
+}
+
+
+@dataclass
+class QueryTemplate:
+    """A parameterized plan plus the keyword groups that identify its question."""
+    name: str
+    # Every group must have at least one of its words in the question.
+    keywords: list[set[str]]
+    build: Callable[[dict], dict]
+    # Slots the template uses; a detected slot it does not use means no match.
+    slots: set[str] = field(default_factory=set)
+    # Other words the template answers correctly, such as ranking words that
+    # agree with its sort direction. Keyword-group words are always allowed.
+    vocabulary: set[str] = field(default_factory=set)
+
+    def words(self) -> set[str]:
+        return set().union(*self.keywords) | self.vocabulary
+
+
+# --- 1. Template Registry ---
+def _region_filter(slots: dict) -> list[dict]:
+    return [{"field": "region", "operator": "==", "value": slots["region"]}] if slots.get("region") else []
+
+
+def _top_projects(measure: str) -> Callable[[dict], dict]:
+    def build(slots: dict) -> dict:
+        return {
+            "collection": "flood_control_projects",
+            "select": ["project_name", "region", "contractor", measure],
+            "where": _region_filter(slots),
+            "order_by": [{"field": measure, "direction": "DESCENDING"}],
+            "limit": slots.get("top_n", DEFAULT_TOP_N),
+        }
+    return build
+
+
+def _grouped(dimension: str, metrics: list[dict], order_field: str, direction: str = "DESCENDING",
+             where: list[dict] | None = None) -> Callable[[dict], dict]:
+    def build(slots: dict) -> dict:
+        return {
+            "collection": "flood_control_projects",
+            "where": (where or []) + _region_filter(slots),
+            "aggregate": {
+                "group_by": [dimension],
+                "metrics": metrics,
+                "order_by": [{"field": order_field, "direction": direction}],
+                "limit": slots.get("top_n"),
+            },
+        }
+    return build
+
+
+_TOTAL_COST = {"field": "contract_cost", "function": "sum", "alias": "total_cost"}
+_TOTAL_BUDGET = {"field": "abc", "function": "sum", "alias": "total_budget_allocation"}
+_PROJECT_COUNT = {"field": "project_name", "function": "count", "alias": "project_count"}
+_AVG_COST = {"field": "contract_cost", "function": "mean", "alias": "avg_contract_cost"}
+
+_MONEY = {"cost", "costs", "spending", "spent", "amount", "value", "contract", "expensive"}
+_BUDGET = {"budget", "abc", "allocation", "allocated", "approved"}
+_COUNT = {"count", "number", "many", "most"}
+# Ranking words that mean "largest first"; only templates sorted DESCENDING accept them.
+_RANKING = {"top", "highest", "largest", "biggest", "most", "greatest", "leading"}
+_TOTAL = {"total", "overall", "sum"}
+# Group nouns whose singular form asks for one answer ("the top contractor").
+_SINGULAR_NOUNS = {"project", "region", "contractor", "office"}
+
+TEMPLATES = [
+    QueryTemplate("top_projects_by_budget", [{"project", "projects"}, {"top", "largest", "biggest", "highest"}, _BUDGET],
+                  _top_projects("abc"), {"top_n", "region"}, _RANKING),
+    QueryTemplate("top_projects_by_cost", [{"project", "projects"}, {"top", "largest", "biggest", "highest", "expensive"}, _MONEY],
+                  _top_projects("contract_cost"), {"top_n", "region"}, _RANKING),
+    QueryTemplate("completed_projects_by_region", [{"region", "regions"}, {"completed", "finished"}, _COUNT | {"projects"}],
+                  _grouped("region", [_PROJECT_COUNT], "project_count",
+                           where=[{"field": "status", "operator": "==", "value": "Completed"}]), {"top_n"}, _RANKING | _TOTAL),
+    QueryTemplate("budget_by_region", [{"region", "regions"}, _BUDGET],
+                  _grouped("region", [_TOTAL_BUDGET], "total_budget_allocation"), {"top_n"}, _RANKING | _TOTAL),
+    QueryTemplate("cost_by_region", [{"region", "regions"}, _MONEY],
+                  _grouped("region", [_TOTAL_COST, _PROJECT_COUNT], "total_cost"), {"top_n"}, _RANKING | _TOTAL),
+    QueryTemplate("average_cost_by_year", [{"average", "avg", "mean"}, {"year", "yearly", "annual", "annually"}],
+                  _grouped("year", [_AVG_COST], "year"), {"region"}, _MONEY),
+    QueryTemplate("projects_by_year", [{"year", "yearly", "annual", "annually"}, {"projects", "count"}],
+                  _grouped("year", [_PROJECT_COUNT, _TOTAL_COST], "year"), {"region"}, {"number", "many", "started"} | _TOTAL),
+    QueryTemplate("cost_by_implementing_office", [{"office", "offices", "implementing"}, _MONEY | {"distribution"}],
+                  _grouped("implementing_office", [_TOTAL_COST, _PROJECT_COUNT], "total_cost"), {"top_n", "region"}, _RANKING | _TOTAL),
+    QueryTemplate("cost_by_contractor", [{"contractor", "contractors"}, _MONEY],
+                  _grouped("contractor", [_TOTAL_COST, _PROJECT_COUNT], "total_cost"), {"top_n", "region"}, _RANKING | _TOTAL),
+    QueryTemplate("projects_by_status", [{"status", "statuses"}, {"projects", "count", "many", "number"}],
+                  _grouped("status", [_PROJECT_COUNT], "project_count"), {"region"}, _TOTAL),
+]
+
+# Validate every template once at import so a schema drift fails loudly here
+# rather than at query time.
+for _template in TEMPLATES:
+    validate_query_plan(_template.build({"top_n": DEFAULT_TOP_N, "region": "Region I"}))
+
+
+# --- 2. Slot Extraction ---
+def _tokenize(question: str) -> list[str]:
+    return re.findall(r"[a-z0-9]+", question.lower())
+
+
+def _extract_top_n(tokens: list[str]) -> tuple[int, int] | None:
+    """Returns the N of "top N" and the position of the number token."""
+    for i, token in enumerate(tokens[:-1]):
+        if token in ("top", "first", "largest", "biggest", "highest"):
+            following = tokens[i + 1]
+            if following.isdigit():
+                return int(following), i + 1
+            if following in _NUMBER_WORDS:
+                return _NUMBER_WORDS[following], i + 1
+    return None
+
+
+def _default_top_n(words: set[str]) -> int:
+    """The N for a ranking question without a number: 1 for a singular group noun, else DEFAULT_TOP_N."""
+    singular = words & _SINGULAR_NOUNS
+    if singular and not {noun + "s" for noun in singular} & words:
+        return 1
+    return DEFAULT_TOP_N
+
+
+def _extract_region(tokens: list[str]) -> tuple[str, range] | None:
+    """
+    Looks for a known region name in the question using only exact and
+    normalized lookups; fuzzy matching is too loose for free text. Returns
+    the region and the token positions it spans.
+    """
+    region_index = get_value_index().get("flood_control_projects", {}).get("region")
+    if region_index is None:
+        return None
+    # Try longer spans first so "region iv a" wins over "region iv".
+    for size in (4, 3, 2, 1):
+        for start in range(len(tokens) - size + 1):
+            span = " ".join(tokens[start:start + size])
+            if span in ("region", "regions"):
+                continue
+            match = region_index.resolve_exact(span)
+            if match:
+                return match, range(start, start + size)
+    return None
+
+
+# --- 3. Matching ---
+def match_canned_query(question: str) -> dict | None:
+    """
+    Returns a precompiled query plan for a recognized question, or None to
+    fall through to LLM planning. A template matches when all its keyword
+    groups are present, every detected slot is one the template can use, and
+    every other word is filler or in the template's vocabulary, so a year, a
+    status, "lowest" or an unresolved place name makes it fall through. The
+    most specific (most keyword groups) match wins. A ranking word with no
+    number limits the result to 1 for a singular noun ("the top contractor")
+    and DEFAULT_TOP_N otherwise.
+    """
+    tokens = _tokenize(question)
+    slots = {}
+    consumed = set()
+    top_n = _extract_top_n(tokens)
+    if top_n:
+        slots["top_n"] = top_n[0]
+        consumed.add(top_n[1])
+    region = _extract_region(tokens)
+    if region:
+        slots["region"] = region[0]
+        consumed.update(region[1])
+
+    words = set(tokens)
+    remaining = {token for i, token in enumerate(tokens) if i not in consumed} - _FILLER
+    candidates = [
+        t for t in TEMPLATES
+        if all(words & group for group in t.keywords) and set(slots) <= t.slots and remaining <= t.words()
+    ]
+    if not candidates:
+        return None
+    best = max(candidates, key=lambda t: len(t.keywords))
+    if sum(1 for t in candidates if len(t.keywords) == len(best.keywords)) > 1:
+        # Two equally specific templates fit; let the LLM decide.
+        return None
+
+    if "top_n" in best.slots and "top_n" not in slots and words & _RANKING:
+        # Region names contain "region", so only words outside slots count.
+        slots["top_n"] = _default_top_n({token for i, token in enumerate(tokens) if i not in consumed})
+
+    plan = copy.deepcopy(best.build(slots))
+    plan["canned_query"] = best.name
+    logging.info(f"Matched canned query '{best.name}' with slots {slots}.")
+    return plan
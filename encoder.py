@@ -0,0 +1,39 @@
+import os
+import json
+import datetime
+import numpy as np
+import pandas as pd
+
+from result_handle import ResultHandle
+
+# Rows of a query result included in an encoded event or batch record. The
+# total is always reported, so clients can tell when they got a prefix.
+ENCODE_MAX_ROWS = int(os.getenv("ENCODE_MAX_ROWS", "10000"))
+
+# --- Custom JSON Encoder ---
+# This class teaches Python's JSON library how to handle special types
+# that it doesn't know about, like NumPy numbers and Pandas DataFrames.
+class CustomJSONEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, (np.integer, np.int64)):
+            return int(obj)
+        if isinstance(obj, (np.floating, np.float64)):
+            return float(obj)
+        if isinstance(obj, (datetime.datetime, datetime.date)):
+            # Covers Firestore timestamps and pandas Timestamps
+            return obj.isoformat()
+        if isinstance(obj, ResultHandle):
+            # Only the leading rows are read, so a spilled result is never loaded whole.
+            encoded = obj.head(ENCODE_MAX_ROWS).to_dict(orient='split')
+            encoded.update(num_rows=obj.num_rows, truncated=obj.num_rows > ENCODE_MAX_ROWS)
+            return encoded
+        if isinstance(obj, pd.DataFrame):
+            # Convert DataFrame to a JSON-friendly dict with 'split' orientation
+            return obj.to_dict(orient='split')
+        # Let the base class default method raise the TypeError
+        return super(CustomJSONEncoder, self).default(obj)
+
+
+def to_sse(event: dict) -> str:
+    """Encodes an event as a Server-Sent Event line. Top-level so worker processes can run it."""
+    return f"data: {json.dumps(event, cls=CustomJSONEncoder)}\n\n"
@@ -0,0 +1,87 @@
+# executors.py
+#
+# Worker pools for CPU-bound work so it stays off the event loop thread:
+#  - a thread pool for NumPy/pandas work, which releases the GIL
+#  - a process pool for pure-Python work such as JSON encoding, which does not
+# plus a monitor that records event-loop lag so stalls are visible in /metrics.
+
+import os
+import time
+import asyncio
+import logging
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import metrics
+
+THREAD_POOL_SIZE = int(os.getenv("CPU_THREAD_POOL_SIZE", str(min(32, (os.cpu_count() or 1) + 4))))
+PROCESS_POOL_SIZE = int(os.getenv("CPU_PROCESS_POOL_SIZE", str(max(1, (os.cpu_count() or 2) // 2))))
+LOOP_LAG_INTERVAL_SECONDS = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+# Workers must not be forked from a process that already runs gRPC (Firestore)
+# and server threads, so they start from a clean forkserver (or spawn) parent.
+PROCESS_START_METHOD = os.getenv("CPU_PROCESS_START_METHOD", "forkserver")
+
+_thread_pool: ThreadPoolExecutor | None = None
+_process_pool: ProcessPoolExecutor | None = None
+
+
+def get_thread_pool() -> ThreadPoolExecutor:
+    global _thread_pool
+    if _thread_pool is None:
+        _thread_pool = ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE, thread_name_prefix="cpu")
+    return _thread_pool
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """
+    Returns the process pool. Create it at startup (see api.lifespan), before
+    any Firestore client exists, so its forkserver starts from a clean process.
+    """
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(
+            max_workers=PROCESS_POOL_SIZE, mp_context=multiprocessing.get_context(PROCESS_START_METHOD)
+        )
+    return _process_pool
+
+
+async def run_in_thread(fn, *args, **kwargs):
+    """Runs fn on the CPU thread pool and awaits the result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_thread_pool(), functools.partial(fn, *args, **kwargs))
+
+
+async def run_in_process(fn, *args):
+    """Runs a picklable top-level fn on the process pool and awaits the result."""
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    result = await loop.run_in_executor(get_process_pool(), fn, *args)
+    metrics.observe("process_pool_task_seconds", time.perf_counter() - start)
+    return result
+
+
+def shutdown_executors():
+    global _thread_pool, _process_pool
+    if _thread_pool is not None:
+        _thread_pool.shutdown(wait=False, cancel_futures=True)
+        _thread_pool = None
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
+
+
+async def monitor_event_loop_lag(interval: float = LOOP_LAG_INTERVAL_SECONDS):
+    """
+    Sleeps for `interval` in a loop and records how late each wake-up is.
+    Anything blocking the loop thread shows up directly as lag.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - start - interval)
+        metrics.observe("event_loop_lag_seconds", lag)
+        metrics.set_gauge("event_loop_lag_seconds_last", lag)
+        if lag > 1.0:
+            logging.warning(f"Event loop was blocked for {lag:.2f}s.")
@@ -1,9 +1,22 @@
 import logging
 import os
+import re
+import copy
+import json
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable
 from dotenv import load_dotenv
 
 import google.generativeai as genai # <-- Required for the model existence check
 from langchain_google_genai import ChatGoogleGenerativeAI
+from langchain_core.runnables import RunnableLambda
+
+import metrics
+from executors import THREAD_POOL_SIZE
 # Load environment variables from .env file
 load_dotenv()
 
@@ -36,3 +49,313 @@ def get_llm(model_name: str, **kwargs) -> ChatGoogleGenerativeAI:
             f"Model '{model_name}' not found. Falling back to default '{DEFAULT_MODEL}'."
         )
         return ChatGoogleGenerativeAI(model=DEFAULT_MODEL, **kwargs)
+
+
+# --- Model Routing ---
+# Picks a model per task and question complexity, tracks rolling latency and
+# error rates per model, hedges slow calls with a secondary model and fails
+# over when a model is unhealthy. Override any part of the policy with the
+# LLM_ROUTING_POLICY environment variable (a JSON string or a path to a JSON file).
+
+DEFAULT_ROUTING_POLICY = {
+    # task -> complexity -> models in preference order (primary first)
+    "tasks": {
+        "planning": {
+            "simple": ["gemini-2.5-flash-lite", "gemini-2.0-flash"],
+            "complex": ["gemini-2.5-flash", "gemini-2.0-flash"],
+        },
+        "visualization": {
+            "simple": ["gemini-2.5-flash-lite", "gemini-2.0-flash"],
+            "complex": ["gemini-2.5-flash-lite", "gemini-2.0-flash"],
+        },
+        "insight": {
+            "simple": ["gemini-2.5-flash", "gemini-2.0-flash"],
+            "complex": ["gemini-2.5-pro", "gemini-2.5-flash"],
+        },
+        "title": {
+            "simple": ["gemini-2.5-flash-lite", "gemini-2.0-flash"],
+            "complex": ["gemini-2.5-flash-lite", "gemini-2.0-flash"],
+        },
+    },
+    # Start a backup call on the secondary model once the primary has been
+    # running this long, if the primary's p95 is above it.
+    "hedge_p95_seconds": 6.0,
+    # Route away from a model whose p95 or error rate goes over these.
+    "failover_p95_seconds": 15.0,
+    "max_error_rate": 0.25,
+    # Rolling window of calls per model, and calls needed before judging health.
+    "window": 50,
+    "min_samples": 5,
+    # How long an unhealthy model is skipped before it gets traffic again.
+    "cooldown_seconds": 60.0,
+    # Backup calls allowed in flight at once (defaults to LLM_HEDGE_POOL_SIZE).
+    "max_concurrent_hedges": None,
+}
+
+# Sized from the CPU thread pool: at most a quarter of the threads that run
+# graph nodes can have a backup call in flight.
+HEDGE_POOL_SIZE = int(os.getenv("LLM_HEDGE_POOL_SIZE", str(max(1, THREAD_POOL_SIZE // 4))))
+
+_COMPLEX_KEYWORDS = {
+    "compare", "comparison", "versus", "vs", "trend", "why", "correlation", "correlate",
+    "relationship", "ratio", "percentage", "growth", "rating", "cpes", "over", "each",
+    "between", "delayed", "performance",
+}
+
+
+def load_routing_policy() -> dict:
+    """Returns DEFAULT_ROUTING_POLICY with any LLM_ROUTING_POLICY overrides merged in."""
+    policy = json.loads(json.dumps(DEFAULT_ROUTING_POLICY))
+    override = os.getenv("LLM_ROUTING_POLICY")
+    if not override:
+        return policy
+    if os.path.exists(override):
+        with open(override, encoding="utf-8") as f:
+            override = f.read()
+    overrides = json.loads(override)
+    for task, models in overrides.pop("tasks", {}).items():
+        policy["tasks"].setdefault(task, {}).update(models)
+    policy.update(overrides)
+    return policy
+
+
+def estimate_complexity(question: str) -> str:
+    """Classifies a question as 'simple' or 'complex' from its length and wording."""
+    words = re.findall(r"[a-z0-9]+", (question or "").lower())
+    score = 0
+    if len(words) > 20:
+        score += 1
+    score += len(set(words) & _COMPLEX_KEYWORDS)
+    if words.count("and") + question.count(",") >= 2:
+        score += 1
+    return "complex" if score >= 2 else "simple"
+
+
+class ModelStats:
+    """Rolling latency and error window for one model."""
+
+    def __init__(self, window: int):
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+        self.unhealthy_since = None
+
+    def record(self, latency: float, ok: bool):
+        self.latencies.append(latency)
+        self.outcomes.append(ok)
+
+    def p95(self) -> float | None:
+        return metrics.percentile(self.latencies, 95)
+
+    def error_rate(self) -> float:
+        return 0.0 if not self.outcomes else 1 - sum(self.outcomes) / len(self.outcomes)
+
+
+class ModelRouter:
+    """
+    Chooses and calls models according to a routing policy. `llm_factory`
+    builds a chat model from a name and kwargs; it defaults to get_llm and
+    can be swapped for a fake model in tests.
+    """
+
+    def __init__(self, policy: dict | None = None, llm_factory: Callable | None = None,
+                 supported_models: Iterable[str] | None = None):
+        self.policy = copy.deepcopy(policy) if policy else load_routing_policy()
+        self.llm_factory = llm_factory or get_llm
+        self._stats: dict[str, ModelStats] = {}
+        self._llms: dict[tuple, object] = {}
+        self._lock = threading.Lock()
+        # Backup calls run on their own small pool. A hedge is only started when
+        # a slot is free, so a slow model under load never gets its traffic doubled.
+        hedge_slots = self.policy.get("max_concurrent_hedges") or HEDGE_POOL_SIZE
+        self._hedge_pool = ThreadPoolExecutor(max_workers=hedge_slots, thread_name_prefix="llm-hedge")
+        self._hedge_slots = threading.BoundedSemaphore(hedge_slots)
+        if supported_models is None and llm_factory is None:
+            try:
+                supported_models = _get_supported_models()
+            except Exception as e:
+                logging.warning(f"Could not list supported models, routing policy left unchecked: {e}")
+        if supported_models is not None:
+            self._check_models(set(supported_models))
+
+    def _check_models(self, supported: set[str]):
+        """
+        Drops policy models the API does not serve. get_llm would silently swap
+        them for DEFAULT_MODEL, making the secondary a copy of the primary and
+        recording stats under a name that was never called.
+        """
+        for task, tiers in self.policy["tasks"].items():
+            for complexity, models in tiers.items():
+                unknown = [m for m in models if m not in supported]
+                if unknown:
+                    logging.warning(f"Routing policy for '{task}' ({complexity}) names unsupported models {unknown}; dropping them.")
+                kept = list(dict.fromkeys(m for m in models if m in supported))
+                tiers[complexity] = kept or [DEFAULT_MODEL]
+
+    # --- Health tracking ---
+    def _get_stats(self, model: str) -> ModelStats:
+        with self._lock:
+            if model not in self._stats:
+                self._stats[model] = ModelStats(self.policy["window"])
+            return self._stats[model]
+
+    def is_healthy(self, model: str) -> bool:
+        stats = self._get_stats(model)
+        with self._lock:
+            if stats.unhealthy_since is not None:
+                if time.monotonic() - stats.unhealthy_since < self.policy["cooldown_seconds"]:
+                    return False
+                # Cooldown over: start from a clean window and let traffic back in.
+                stats.latencies.clear()
+                stats.outcomes.clear()
+                stats.unhealthy_since = None
+                return True
+            if len(stats.outcomes) < self.policy["min_samples"]:
+                return True
+            p95 = stats.p95()
+            if stats.error_rate() > self.policy["max_error_rate"] or (p95 is not None and p95 > self.policy["failover_p95_seconds"]):
+                stats.unhealthy_since = time.monotonic()
+                logging.warning(f"Model '{model}' marked unhealthy (p95={p95}, errors={stats.error_rate():.0%}).")
+                return False
+            return True
+
+    def _record(self, model: str, latency: float, ok: bool):
+        stats = self._get_stats(model)
+        with self._lock:
+            stats.record(latency, ok)
+        metrics.observe("llm_latency_seconds", latency, labels={"model": model})
+        if not ok:
+            metrics.increment("llm_errors_total", labels={"model": model})
+
+    # --- Routing ---
+    def route(self, task: str, complexity: str) -> list[str]:
+        """Returns the models to try for a task, healthy ones first, in policy order."""
+        tier = self.policy["tasks"].get(task) or self.policy["tasks"]["planning"]
+        candidates = tier.get(complexity) or tier["simple"]
+        healthy = [m for m in candidates if self.is_healthy(m)]
+        ordered = healthy + [m for m in candidates if m not in healthy]
+        reason = "primary" if ordered[0] == candidates[0] else "failover"
+        metrics.increment("llm_route_total", labels={"task": task, "complexity": complexity, "model": ordered[0], "reason": reason})
+        logging.info(f"Routing '{task}' ({complexity}) to '{ordered[0]}' [{reason}].")
+        return ordered
+
+    def _get_llm(self, model: str, kwargs: dict):
+        key = (model, tuple(sorted(kwargs.items())))
+        with self._lock:
+            if key not in self._llms:
+                self._llms[key] = self.llm_factory(model, **kwargs)
+            return self._llms[key]
+
+    def _call(self, model: str, kwargs: dict, prompt):
+        start = time.perf_counter()
+        try:
+            result = self._get_llm(model, kwargs).invoke(prompt)
+        except Exception:
+            self._record(model, time.perf_counter() - start, ok=False)
+            raise
+        self._record(model, time.perf_counter() - start, ok=True)
+        return result
+
+    def _hedged_call(self, task: str, primary: str, backup: str, kwargs: dict, prompt) -> list[tuple]:
+        """
+        Runs the primary and, if it has not answered after hedge_p95_seconds
+        and a hedge slot is free, a backup call. Returns (model, ok, value)
+        outcomes in completion order, stopping at the first success; a call
+        that loses the race is ignored.
+        """
+        outcomes = queue.SimpleQueue()
+
+        def run(model: str):
+            try:
+                outcomes.put((model, True, self._call(model, kwargs, prompt)))
+            except Exception as e:
+                outcomes.put((model, False, e))
+
+        # The primary starts at once on its own thread rather than queueing in
+        # a shared pool, so hedge_p95_seconds measures the call itself and the
+        # caller stays free to take whichever answer comes first.
+        threading.Thread(target=run, args=(primary,), name="llm-primary", daemon=True).start()
+        launched = 1
+        try:
+            first = outcomes.get(timeout=self.policy["hedge_p95_seconds"])
+        except queue.Empty:
+            if self._hedge_slots.acquire(blocking=False):
+                metrics.increment("llm_hedges_total", labels={"task": task, "model": backup})
+                logging.info(f"Hedging slow '{primary}' with '{backup}'.")
+
+                def run_backup():
+                    try:
+                        run(backup)
+                    finally:
+                        self._hedge_slots.release()
+
+                self._hedge_pool.submit(run_backup)
+                launched += 1
+            else:
+                metrics.increment("llm_hedges_skipped_total", labels={"task": task, "model": backup})
+            first = outcomes.get()
+
+        results = [first]
+        while not results[-1][1] and len(results) < launched:
+            results.append(outcomes.get())
+        return results
+
+    def invoke(self, task: str, prompt, complexity: str = "simple", **kwargs):
+        """
+        Calls the routed model. If the primary's p95 is above the hedge
+        threshold, a backup call to the secondary starts after that long and
+        the first answer wins. If the primary fails, the next model is tried.
+        """
+        models = self.route(task, complexity)
+        primary, fallbacks = models[0], models[1:]
+        primary_p95 = self._get_stats(primary).p95()
+
+        if fallbacks and primary_p95 is not None and primary_p95 > self.policy["hedge_p95_seconds"]:
+            results = self._hedged_call(task, primary, fallbacks[0], kwargs, prompt)
+            model, ok, value = results[-1]
+            if ok:
+                return value
+            tried = {m for m, _, _ in results}
+            fallbacks = [m for m in fallbacks if m not in tried]
+            if not fallbacks:
+                raise value
+        else:
+            try:
+                return self._call(primary, kwargs, prompt)
+            except Exception as e:
+                if not fallbacks:
+                    raise
+                logging.warning(f"Model '{primary}' failed ({e}); failing over to '{fallbacks[0]}'.")
+
+        for i, model in enumerate(fallbacks):
+            metrics.increment("llm_route_total", labels={"task": task, "complexity": complexity, "model": model, "reason": "error_failover"})
+            try:
+                return self._call(model, kwargs, prompt)
+            except Exception:
+                if i == len(fallbacks) - 1:
+                    raise
+
+
+_router: ModelRouter | None = None
+
+
+def get_router() -> ModelRouter:
+    global _router
+    if _router is None:
+        _router = ModelRouter()
+    return _router
+
+
+def set_router(router: ModelRouter):
+    """Replaces the process-wide router, e.g. with one built on a fake model in tests."""
+    global _router
+    _router = router
+
+
+def get_routed_llm(task: str, question: str = "", complexity: str | None = None, **kwargs) -> RunnableLambda:
+    """
+    Returns a runnable that can stand in for a chat model in a chain
+    (`prompt | get_routed_llm(...) | parser`) and routes each call through
+    the process-wide ModelRouter.
+    """
+    complexity = complexity or estimate_complexity(question)
+    return RunnableLambda(lambda prompt: get_router().invoke(task, prompt, complexity=complexity, **kwargs))
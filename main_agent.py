@@ -1,17 +1,22 @@
+import os
 import logging
 import json
 from dotenv import load_dotenv
 from typing import TypedDict
-import pandas as pd
 
 # LangGraph libraries for building the agent workflow
 from langgraph.graph import StateGraph, END
+from langgraph.config import get_stream_writer
+from langchain_core.runnables import RunnableConfig
 
 # Import your specialist functions and classes
 from tools import generate_firestore_query_plan, execute_firestore_query, recommend_visualization, generate_insight_from_data
 from formatter import DataFormatter
-from llm_config import get_llm
+from llm_config import get_routed_llm
 from schema import FIRESTORE_SCHEMA
+from batch import get_batch_cache
+from canned_queries import match_canned_query
+from result_handle import ResultHandle
 
 # Load environment variables from .env file
 load_dotenv()
@@ -23,41 +28,62 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(
 class AgentState(TypedDict):
     question: str
     firestore_query_plan: dict
-    sql_dataframe: pd.DataFrame
+    # Large results are spilled to disk; read them with .head(), .iter_batches()
+    # or .to_frame(columns) rather than loading the whole result.
+    sql_dataframe: ResultHandle
     visualization: str
     formatted_data_for_visualization: dict
     insight: str
     error: str
 
 # --- 2. Create Instances of Our Tools ---
-helper_llm = get_llm(model_name="gemini-1.5-flash", temperature=0)
+helper_llm = get_routed_llm("title", complexity="simple", temperature=0)
 formatter = DataFormatter(llm=helper_llm)
+# Rows passed to the chart formatter; larger results are charted from their head.
+CHART_MAX_ROWS = int(os.getenv("CHART_MAX_ROWS", "1000"))
 
 # --- 3. Define the Nodes for our Graph ---
 
 def firestore_query_plan_node(state: AgentState):
     """Generates a structured query plan for Firestore."""
     logging.info("---NODE: GENERATING FIRESTORE QUERY PLAN---")
-    query_plan = generate_firestore_query_plan(state['question'], FIRESTORE_SCHEMA)
+    question = state['question']
+    # Recognized questions skip LLM planning entirely.
+    canned_plan = match_canned_query(question)
+    if canned_plan:
+        return {"firestore_query_plan": canned_plan}
+    query_plan = generate_firestore_query_plan(question, FIRESTORE_SCHEMA)
     return {"firestore_query_plan": query_plan}
 
-def firestore_execution_node(state: AgentState):
+def firestore_execution_node(state: AgentState, config: RunnableConfig):
     """Executes the Firestore query plan."""
     logging.info("---NODE: EXECUTING FIRESTORE QUERY---")
-    execution_result = execute_firestore_query(state['firestore_query_plan'])
+    query_plan = state['firestore_query_plan']
+    batch_cache = get_batch_cache(config)
+    if batch_cache:
+        execution_result = batch_cache.result(query_plan, lambda: execute_firestore_query(query_plan))
+    else:
+        # Row chunks go out on the 'custom' stream while the query is still running.
+        writer = get_stream_writer()
+        execution_result = execute_firestore_query(query_plan, on_rows_chunk=lambda chunk: writer({"rows_chunk": chunk}))
     if "error" in execution_result:
-        return {"error": execution_result["error"], "sql_dataframe": pd.DataFrame()}
-    return {"sql_dataframe": execution_result["sql_dataframe"]}
+        return {"error": execution_result["error"], "sql_dataframe": execution_result["sql_dataframe"]}
+    # The plan that ran may differ from the LLM's after validation repairs.
+    # Cached handles are shared across the batch; nodes only read from them.
+    return {
+        "sql_dataframe": execution_result["sql_dataframe"],
+        "firestore_query_plan": execution_result.get("firestore_query_plan", query_plan),
+    }
 
 def visualizer_node(state: AgentState):
     """Recommends a visualization type based on the query result."""
     logging.info("---NODE: RECOMMENDING VISUALIZATION---")
-    df = state.get('sql_dataframe')
-    if state.get("error") or df is None or df.empty:
+    result = state.get('sql_dataframe')
+    if state.get("error") or result is None or result.empty:
         logging.warning("Skipping visualization due to error or no data.")
         return {"visualization": "none"}
     
-    recommendation = recommend_visualization(state['question'], df)
+    recommendation = recommend_visualization(state['question'], result)
     
     try:
         chart_type = recommendation.split('\n')[0].split(':')[1].strip()
@@ -68,17 +94,23 @@ def visualizer_node(state: AgentState):
 def formatter_node(state: AgentState):
     """Formats the data into a chart-ready JSON object."""
     logging.info("---NODE: FORMATTING DATA---")
-    formatted_data_dict = formatter.format_data_for_visualization(state)
+    result = state.get('sql_dataframe')
+    # A chart cannot show more points than this anyway, so only read that many rows.
+    df = result.head(CHART_MAX_ROWS).copy() if result is not None else None
+    if result is not None and len(result) > CHART_MAX_ROWS:
+        logging.info(f"Charting the first {CHART_MAX_ROWS} of {len(result)} rows.")
+    formatted_data_dict = formatter.format_data_for_visualization({**state, "sql_dataframe": df})
     return {"formatted_data_for_visualization": formatted_data_dict}
 
 def insight_node(state: AgentState):
     """Generates an insight from the data."""
     logging.info("---NODE: GENERATING INSIGHT---")
-    if state.get("error") or state.get("sql_dataframe") is None or state.get("sql_dataframe").empty:
+    result = state.get("sql_dataframe")
+    if state.get("error") or result is None or result.empty:
         logging.warning("Skipping insight generation due to error or no data.")
         return {"insight": "No insight available."}
     
-    insight = generate_insight_from_data(state['question'], state['sql_dataframe'])
+    insight = generate_insight_from_data(state['question'], result)
     return {"insight": insight}
 
 # --- 4. Build the Graph ---
@@ -124,7 +156,7 @@ def main():
 
     print("## Data Result:\n")
     if final_state.get("sql_dataframe") is not None and not final_state["sql_dataframe"].empty:
-        print(final_state["sql_dataframe"].to_string())
+        print(final_state["sql_dataframe"].head(50).to_string())
     else:
         print("No data was returned from the query.")
     print("\n" + "-"*50 + "\n")
@@ -0,0 +1,71 @@
+# metrics.py
+#
+# Minimal in-process metrics registry: counters, gauges and rolling
+# histograms, exposed as JSON by the API's /metrics endpoint.
+
+import threading
+from collections import defaultdict, deque
+
+# Number of most recent observations kept per histogram.
+HISTOGRAM_WINDOW = 1000
+
+_lock = threading.Lock()
+_counters: dict[str, float] = defaultdict(float)
+_gauges: dict[str, float] = {}
+_histograms: dict[str, deque] = defaultdict(lambda: deque(maxlen=HISTOGRAM_WINDOW))
+
+
+def _key(name: str, labels: dict | None) -> str:
+    if not labels:
+        return name
+    return name + "{" + ",".join(f"{k}={v}" for k, v in sorted(labels.items())) + "}"
+
+
+def increment(name: str, value: float = 1, labels: dict | None = None):
+    with _lock:
+        _counters[_key(name, labels)] += value
+
+
+def set_gauge(name: str, value: float, labels: dict | None = None):
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name: str, value: float, labels: dict | None = None):
+    with _lock:
+        _histograms[_key(name, labels)].append(value)
+
+
+def percentile(values, q: float) -> float | None:
+    """Nearest-rank percentile of a sequence, q in [0, 100]."""
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(values) -> dict:
+    values = list(values)
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values),
+    }
+
+
+def snapshot() -> dict:
+    """Returns the current value of every metric."""
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        histograms = {name: list(values) for name, values in _histograms.items()}
+    return {
+        "counters": counters,
+        "gauges": gauges,
+        "histograms": {name: summarize(values) for name, values in histograms.items()},
+    }
@@ -0,0 +1,179 @@
+# prompt_builder.py
+#
+# Builds the variable parts of our LLM prompts within a token budget:
+#  - a compact, precomputed rendering of the Firestore schema
+#  - a statistical profile of a query result instead of a raw head() dump
+
+import os
+from typing import Iterable
+import pandas as pd
+
+from schema import FIRESTORE_SCHEMA
+from result_handle import ResultHandle
+
+# Per-call budgets (in estimated tokens) for the content we inject into each prompt.
+TOKEN_BUDGETS = {
+    "plan": int(os.getenv("PROMPT_BUDGET_PLAN", "1000")),
+    "visualization": int(os.getenv("PROMPT_BUDGET_VISUALIZATION", "600")),
+    "insight": int(os.getenv("PROMPT_BUDGET_INSIGHT", "2500")),
+}
+
+# Number of most frequent values reported for each text column.
+TOP_K_CATEGORIES = 5
+# Distinct values tracked per text column while profiling a large result.
+PROFILE_MAX_DISTINCT = int(os.getenv("PROFILE_MAX_DISTINCT", "50000"))
+
+_TYPE_ABBREVIATIONS = {"string": "str", "number": "num", "timestamp": "ts", "boolean": "bool"}
+
+
+# --- 1. Token Estimation and Budgeting ---
+def estimate_tokens(text: str) -> int:
+    """Rough token count for Gemini models (about 4 characters per token)."""
+    return len(text) // 4 + 1
+
+
+def fit_to_budget(text: str, max_tokens: int) -> str:
+    """Trims text at a line boundary so it fits within max_tokens."""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    marker = "... (truncated)"
+    max_chars = max(0, (max_tokens - estimate_tokens(marker)) * 4)
+    kept = text[:max_chars]
+    if "\n" in kept:
+        kept = kept[:kept.rindex("\n")]
+    return f"{kept}\n{marker}"
+
+
+# --- 2. Schema Rendering ---
+def render_schema(schema: dict) -> str:
+    """Renders a schema as one line per collection, e.g. `cpes_projects(project_name:str, ...)`."""
+    lines = []
+    for collection, spec in schema.items():
+        fields = ", ".join(
+            f"{name}:{_TYPE_ABBREVIATIONS.get(field_type, field_type)}"
+            for name, field_type in spec.get("fields", {}).items()
+        )
+        lines.append(f"{collection}({fields})")
+    return "\n".join(lines)
+
+
+# Rendered once at import; the schema is static for the life of the process.
+COMPACT_SCHEMA = render_schema(FIRESTORE_SCHEMA)
+
+
+def build_schema_prompt(schema: dict, max_tokens: int = TOKEN_BUDGETS["plan"]) -> str:
+    rendered = COMPACT_SCHEMA if schema is FIRESTORE_SCHEMA else render_schema(schema)
+    return fit_to_budget(rendered, max_tokens)
+
+
+# --- 3. Data Profiling ---
+def _format_number(value) -> str:
+    if pd.isna(value):
+        return "n/a"
+    return f"{value:,.2f}" if abs(value) < 1e15 else f"{value:.3e}"
+
+
+def _merge_stat(stats: dict, col, value, pick):
+    if pd.isna(value):
+        return
+    stats[col] = value if col not in stats else pick(stats[col], value)
+
+
+def profile_batches(batches: Iterable[pd.DataFrame], top_k: int = TOP_K_CATEGORIES) -> str:
+    """
+    Summarizes every column of a result given as a sequence of frames: dtype,
+    null rate, min/max/mean for numeric columns, range for dates, and the
+    top-k values for text columns. Statistics are merged batch by batch, so
+    only one batch (plus the running value counts) is in memory at a time.
+    """
+    rows, dtypes, nulls = 0, {}, {}
+    mins, maxes, sums, counts = {}, {}, {}, {}
+    value_counts, capped = {}, set()
+    for df in batches:
+        if not dtypes:
+            dtypes = {col: df[col].dtype for col in df.columns}
+        if df.empty:
+            continue
+        rows += len(df)
+        for col, n in df.isna().sum().items():
+            nulls[col] = nulls.get(col, 0) + int(n)
+        numeric = df.select_dtypes(include=["number"])
+        if not numeric.empty:
+            stats = numeric.agg(["min", "max", "sum", "count"])
+            for col in numeric.columns:
+                _merge_stat(mins, col, stats[col]["min"], min)
+                _merge_stat(maxes, col, stats[col]["max"], max)
+                sums[col] = sums.get(col, 0) + stats[col]["sum"]
+                counts[col] = counts.get(col, 0) + stats[col]["count"]
+        dates = df.select_dtypes(include=["datetime", "datetimetz"])
+        if not dates.empty:
+            stats = dates.agg(["min", "max"])
+            for col in dates.columns:
+                _merge_stat(mins, col, stats[col]["min"], min)
+                _merge_stat(maxes, col, stats[col]["max"], max)
+        for col in df.columns.difference(numeric.columns).difference(dates.columns):
+            batch_counts = df[col].dropna().astype(str).value_counts()
+            merged = batch_counts if col not in value_counts else value_counts[col].add(batch_counts, fill_value=0)
+            if len(merged) > PROFILE_MAX_DISTINCT:
+                # Keep memory bounded on high-cardinality columns; top-k stays
+                # accurate for values frequent enough to matter.
+                merged = merged.nlargest(PROFILE_MAX_DISTINCT // 2)
+                capped.add(col)
+            value_counts[col] = merged
+
+    lines = [f"rows: {rows}, columns: {len(dtypes)}"]
+    if rows == 0:
+        return "\n".join(lines)
+    for col, dtype in dtypes.items():
+        header = f"{col} ({dtype}, nulls {nulls.get(col, 0) / rows:.1%})"
+        if col in counts:
+            mean = sums[col] / counts[col] if counts[col] else float("nan")
+            lines.append(
+                f"{header}: min {_format_number(mins.get(col, float('nan')))}, "
+                f"max {_format_number(maxes.get(col, float('nan')))}, mean {_format_number(mean)}"
+            )
+        elif col in value_counts or col not in mins:
+            col_counts = value_counts.get(col, pd.Series(dtype="int64")).sort_values(ascending=False, kind="stable")
+            top = ", ".join(f"{value}={int(count)}" for value, count in col_counts.head(top_k).items())
+            distinct = f"{len(col_counts)}+" if col in capped else str(len(col_counts))
+            lines.append(f"{header}, {distinct} distinct: top {top}")
+        else:
+            lines.append(f"{header}: from {mins[col]} to {maxes[col]}")
+    return "\n".join(lines)
+
+
+def profile_dataframe(df: pd.DataFrame, top_k: int = TOP_K_CATEGORIES) -> str:
+    """Summarizes every column of a DataFrame (see profile_batches)."""
+    return profile_batches([df], top_k)
+
+
+def build_data_summary(result: pd.DataFrame | ResultHandle, max_tokens: int) -> str:
+    """
+    Returns the column profile of a result followed by as many leading rows as
+    fit in the budget. Small results are therefore sent in full, large ones as
+    a profile. A ResultHandle is profiled batch by batch and only its leading
+    rows are read, so a spilled result is never loaded whole.
+    """
+    batches = result.iter_batches() if isinstance(result, ResultHandle) else [result]
+    profile = fit_to_budget(profile_batches(batches), max_tokens)
+    remaining = max_tokens - estimate_tokens(profile)
+    if remaining <= 0:
+        return profile
+
+    # Every row costs at least one token, so never render more rows than the budget.
+    head = result.head(remaining)
+    rows = head.to_string(index=False, max_rows=len(head)).split("\n")
+    kept = []
+    used = 0
+    for row in rows:
+        cost = estimate_tokens(row)
+        if used + cost > remaining:
+            break
+        kept.append(row)
+        used += cost
+    # Fewer than a header plus one row is not worth sending.
+    if len(kept) < 2:
+        return profile
+    shown = len(kept) - 1
+    label = "All rows" if shown == len(result) else f"First {shown} of {len(result)} rows"
+    return f"{profile}\n\n{label}:\n" + "\n".join(kept)
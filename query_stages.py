@@ -0,0 +1,136 @@
+# query_stages.py
+#
+# In-memory stages that run after the Firestore reads of a query plan:
+#  - hash join of two filtered collections, canonicalizing contractor names
+#    through the `contractor_name_mapping` collection
+#  - derived fields (e.g. year from date_started) and group-by aggregation
+
+import os
+import time
+import logging
+import threading
+import pandas as pd
+
+from schema import DERIVED_FIELDS
+
+MAPPING_CACHE_TTL_SECONDS = int(os.getenv("JOIN_MAPPING_CACHE_TTL", "3600"))
+
+# --- 1. Resident Name Mapping Index ---
+_mapping_cache: dict[str, tuple[float, dict[str, str]]] = {}
+_mapping_lock = threading.Lock()
+
+
+def _normalize_keys(values: pd.Series) -> pd.Series:
+    return values.astype("string").str.strip().str.upper()
+
+
+def get_name_mapping(db, collection: str = "contractor_name_mapping") -> dict[str, str]:
+    """
+    Returns the old -> new name mapping as a dict keyed by normalized name.
+    The whole collection is small, so it is read once and kept resident for
+    MAPPING_CACHE_TTL_SECONDS instead of being queried per join.
+    """
+    now = time.monotonic()
+    with _mapping_lock:
+        cached = _mapping_cache.get(collection)
+        if cached and now - cached[0] < MAPPING_CACHE_TTL_SECONDS:
+            return cached[1]
+
+    rows = [doc.to_dict() for doc in db.collection(collection).stream()]
+    mapping = {}
+    if rows:
+        df = pd.DataFrame(rows).dropna(subset=["old_contractor_name", "new_contractor_name"])
+        mapping = dict(zip(_normalize_keys(df["old_contractor_name"]), _normalize_keys(df["new_contractor_name"])))
+    logging.info(f"Loaded {len(mapping)} entries from '{collection}' into the join index.")
+    with _mapping_lock:
+        _mapping_cache[collection] = (now, mapping)
+    return mapping
+
+
+def clear_name_mappings():
+    """Drops the resident mapping index, e.g. after a data sync."""
+    with _mapping_lock:
+        _mapping_cache.clear()
+
+
+def canonical_keys(values: pd.Series, mapping: dict[str, str] | None) -> pd.Series:
+    """Normalizes join keys and, when a mapping is given, replaces old names with current ones."""
+    keys = _normalize_keys(values)
+    if mapping:
+        keys = keys.map(mapping).fillna(keys)
+    return keys
+
+
+# --- 2. Hash Join ---
+_JOIN_KEY = "_join_key"
+
+
+def hash_join(left: pd.DataFrame, right: pd.DataFrame, join: dict, mapping: dict[str, str] | None = None) -> pd.DataFrame:
+    """
+    Joins two already-filtered frames on join["on"]. If join["aggregate"]
+    is set, the right side is first reduced to one row per key, which keeps
+    the join many-to-one. Cost is linear in the sizes of the two inputs.
+    The inputs are not modified, and their data is not copied before the
+    merge, so peak memory is the inputs plus the joined frame.
+    """
+    on = join["on"]
+    if left.empty or on not in left.columns:
+        return pd.DataFrame(columns=left.columns)
+    if right.empty or on not in right.columns:
+        return left.iloc[0:0] if join["how"] == "inner" else left
+
+    # Shallow copies: assigning a column replaces it in the copy only.
+    left = left.copy(deep=False)
+    left[_JOIN_KEY] = canonical_keys(left[on], mapping)
+    right = right.copy(deep=False)
+    right[_JOIN_KEY] = canonical_keys(right[on], mapping)
+    if mapping:
+        # Rows under an old name take the current one, so a later group-by on
+        # the join field sees each contractor once. The current name is shown
+        # as spelled in the data when it appears there, else as its key.
+        spellings = left[on].astype("string").str.strip().groupby(_normalize_keys(left[on])).first()
+        left[on] = left[_JOIN_KEY].map(spellings).fillna(left[_JOIN_KEY])
+
+    if join.get("aggregate"):
+        right = right.groupby(_JOIN_KEY, as_index=False).agg(join["aggregate"])
+
+    suffix = f"_{join['collection']}"
+    joined = left.merge(right, on=_JOIN_KEY, how=join["how"], suffixes=("", suffix))
+    del left, right
+    for column in (_JOIN_KEY, f"{on}{suffix}"):
+        if column in joined.columns:
+            del joined[column]
+    return joined
+
+
+# --- 3. Derived Fields and Aggregation ---
+def add_derived_fields(df: pd.DataFrame, collection: str) -> pd.DataFrame:
+    """Adds the DERIVED_FIELDS of a collection whose source column is present."""
+    for name, spec in DERIVED_FIELDS.get(collection, {}).items():
+        if spec["source"] in df.columns and name not in df.columns:
+            if spec["transform"] == "year":
+                df = df.assign(**{name: pd.to_datetime(df[spec["source"]], errors="coerce", utc=True).dt.year.astype("Int64")})
+    return df
+
+
+def apply_aggregate(df: pd.DataFrame, aggregate: dict) -> pd.DataFrame:
+    """Applies a validated aggregate stage: group_by, metrics, order_by and limit."""
+    named = {m["alias"]: pd.NamedAgg(column=m["field"], aggfunc=m["function"]) for m in aggregate["metrics"] if m["field"] in df.columns}
+    if not named:
+        return pd.DataFrame(columns=aggregate["group_by"] + [m["alias"] for m in aggregate["metrics"]])
+
+    group_by = [f for f in aggregate["group_by"] if f in df.columns]
+    if group_by:
+        result = df.groupby(group_by, dropna=False, as_index=False).agg(**named)
+    else:
+        result = pd.DataFrame({alias: [df[agg.column].agg(agg.aggfunc)] for alias, agg in named.items()})
+
+    order_by = [o for o in aggregate.get("order_by", []) if o["field"] in result.columns]
+    if order_by:
+        result = result.sort_values(
+            [o["field"] for o in order_by],
+            ascending=[o["direction"] != "DESCENDING" for o in order_by],
+        )
+    if aggregate.get("limit"):
+        result = result.head(aggregate["limit"])
+    return result.reset_index(drop=True)
@@ -0,0 +1,510 @@
+# query_validator.py
+#
+# Static checks for LLM-generated Firestore query plans, run before anything
+# reaches Firestore. The validator:
+#  - repairs common mistakes (field/collection typos, operator spellings,
+#    string numbers and dates, missing or oversized limits) without another
+#    LLM call
+#  - detects query shapes that would need a composite index we have not
+#    deployed and moves the offending sort/filter into an in-memory stage
+#  - estimates document reads from cached collection counts and rejects
+#    plans that would scan too much
+
+import os
+import json
+import time
+import difflib
+import datetime
+import logging
+import threading
+from typing import Callable
+
+from schema import DERIVED_FIELDS, FIRESTORE_SCHEMA
+
+# --- Configuration ---
+DEFAULT_LIMIT = int(os.getenv("QUERY_DEFAULT_LIMIT", "100"))
+MAX_LIMIT = int(os.getenv("QUERY_MAX_LIMIT", "1000"))
+# Upper bound on estimated document reads for a single plan.
+MAX_ESTIMATED_READS = int(os.getenv("QUERY_MAX_READS", "20000"))
+COUNT_CACHE_TTL_SECONDS = int(os.getenv("QUERY_COUNT_CACHE_TTL", "600"))
+
+# Composite indexes deployed on the Firestore database, read from the
+# Firebase CLI's index file (`firebase deploy --only firestore:indexes`).
+FIRESTORE_INDEXES_PATH = os.getenv("FIRESTORE_INDEXES_PATH", "firestore.indexes.json")
+
+EQUALITY_OPERATORS = {"==", "in", "array-contains", "array-contains-any"}
+INEQUALITY_OPERATORS = {"<", "<=", ">", ">=", "!=", "not-in"}
+
+_OPERATOR_ALIASES = {
+    "=": "==", "eq": "==", "is": "==",
+    "<>": "!=", "ne": "!=",
+    "lt": "<", "lte": "<=", "=<": "<=",
+    "gt": ">", "gte": ">=", "=>": ">=",
+    "not in": "not-in", "not_in": "not-in", "nin": "not-in",
+    "array_contains": "array-contains", "contains": "array-contains",
+    "array_contains_any": "array-contains-any",
+}
+
+# Rough fraction of documents each kind of filter keeps, used for read estimates.
+_SELECTIVITY = {"==": 0.1, "array-contains": 0.1, "!=": 0.9, "not-in": 0.9}
+_RANGE_SELECTIVITY = 0.33
+
+# Firestore caps the number of values in an 'in'/'not-in'/'array-contains-any' list.
+MAX_DISJUNCTION_VALUES = 30
+
+
+class QueryPlanError(ValueError):
+    """Raised when a query plan cannot be repaired into something safe to run."""
+
+
+def load_composite_indexes(path: str = FIRESTORE_INDEXES_PATH) -> set[tuple[str, tuple[str, ...]]]:
+    """
+    Reads composite indexes from a firestore.indexes.json file as
+    (collection, (field, ...)) with fields in index order. A missing file
+    means no composite indexes are known.
+    """
+    if not os.path.exists(path):
+        logging.info(f"No Firestore index file at '{path}'; filter+sort shapes will run in memory.")
+        return set()
+    with open(path, encoding="utf-8") as f:
+        spec = json.load(f)
+    return {
+        (index["collectionGroup"], tuple(field["fieldPath"] for field in index.get("fields", [])))
+        for index in spec.get("indexes", [])
+    }
+
+
+# Plans that need an index not listed here are rewritten to sort/filter in
+# memory instead. Indexes Firestore reports as missing at query time are
+# dropped with mark_index_missing, so the next validation avoids them.
+COMPOSITE_INDEXES: set[tuple[str, tuple[str, ...]]] = load_composite_indexes()
+_missing_indexes: set[tuple[str, tuple[str, ...]]] = set()
+
+
+def mark_index_missing(collection: str, fields: tuple[str, ...]):
+    """Records that Firestore rejected a query for lack of this index (FAILED_PRECONDITION)."""
+    logging.warning(f"Composite index {fields} on '{collection}' is not deployed; planning around it from now on.")
+    _missing_indexes.add((collection, fields))
+
+
+# --- 1. Cached Collection Counts ---
+_count_cache: dict[str, tuple[float, int]] = {}
+_count_lock = threading.Lock()
+
+
+def get_collection_count(db, collection: str) -> int:
+    """
+    Returns the document count for a collection using a Firestore count
+    aggregation, cached for COUNT_CACHE_TTL_SECONDS.
+    """
+    now = time.monotonic()
+    with _count_lock:
+        cached = _count_cache.get(collection)
+        if cached and now - cached[0] < COUNT_CACHE_TTL_SECONDS:
+            return cached[1]
+
+    result = db.collection(collection).count().get()
+    count = int(result[0][0].value)
+    with _count_lock:
+        _count_cache[collection] = (now, count)
+    return count
+
+
+def clear_collection_counts():
+    """Drops cached counts, e.g. after a data sync."""
+    with _count_lock:
+        _count_cache.clear()
+
+
+# --- 2. Repair Helpers ---
+def _resolve_name(name, candidates: list[str], kind: str, repairs: list[str]) -> str:
+    if not isinstance(name, str) or not name:
+        raise QueryPlanError(f"Invalid {kind} name: {name!r}")
+    if name in candidates:
+        return name
+    by_lower = {c.lower(): c for c in candidates}
+    normalized = name.strip().lower().replace(" ", "_").replace("-", "_")
+    match = by_lower.get(normalized)
+    if match is None:
+        close = difflib.get_close_matches(normalized, list(by_lower), n=1, cutoff=0.8)
+        match = by_lower[close[0]] if close else None
+    if match is None:
+        raise QueryPlanError(f"Unknown {kind} '{name}'. Expected one of: {', '.join(candidates)}")
+    repairs.append(f"{kind} '{name}' -> '{match}'")
+    return match
+
+
+def _normalize_operator(operator, repairs: list[str]) -> str:
+    op = str(operator).strip().lower()
+    op = _OPERATOR_ALIASES.get(op, op)
+    if op not in EQUALITY_OPERATORS | INEQUALITY_OPERATORS:
+        raise QueryPlanError(f"Unsupported operator '{operator}'.")
+    if op != operator:
+        repairs.append(f"operator '{operator}' -> '{op}'")
+    return op
+
+
+def _coerce_value(value, field_type: str, field: str, repairs: list[str]):
+    if field_type == "number" and isinstance(value, str):
+        try:
+            coerced = float(value.replace(",", "").strip())
+        except ValueError:
+            raise QueryPlanError(f"Value {value!r} for numeric field '{field}' is not a number.")
+        coerced = int(coerced) if coerced.is_integer() else coerced
+        repairs.append(f"value {value!r} for '{field}' -> {coerced}")
+        return coerced
+    if field_type == "timestamp" and isinstance(value, str):
+        # Firestore compares a string with timestamps by type order, so the
+        # filter would silently match nothing.
+        try:
+            coerced = datetime.datetime.fromisoformat(value.strip())
+        except ValueError:
+            raise QueryPlanError(f"Value {value!r} for timestamp field '{field}' is not an ISO date.")
+        if coerced.tzinfo is None:
+            coerced = coerced.replace(tzinfo=datetime.timezone.utc)
+        repairs.append(f"value {value!r} for '{field}' -> {coerced.isoformat()}")
+        return coerced
+    return value
+
+
+def _normalize_limit(limit, repairs: list[str]) -> int:
+    try:
+        value = int(limit)
+    except (TypeError, ValueError):
+        repairs.append(f"limit {limit!r} -> {DEFAULT_LIMIT}")
+        return DEFAULT_LIMIT
+    if value < 1:
+        repairs.append(f"limit {value} -> {DEFAULT_LIMIT}")
+        return DEFAULT_LIMIT
+    if value > MAX_LIMIT:
+        repairs.append(f"limit {value} clamped to {MAX_LIMIT}")
+        return MAX_LIMIT
+    return value
+
+
+def _validate_conditions(conditions, fields: dict, repairs: list[str]) -> list[dict]:
+    validated = []
+    for condition in conditions or []:
+        if not isinstance(condition, dict) or "field" not in condition:
+            raise QueryPlanError(f"Malformed where condition: {condition!r}")
+        field = _resolve_name(condition["field"], list(fields), "field", repairs)
+        op = _normalize_operator(condition.get("operator", "=="), repairs)
+        value = condition.get("value")
+        if op in {"in", "not-in", "array-contains-any"}:
+            if not isinstance(value, list):
+                repairs.append(f"value for '{field}' wrapped in a list for '{op}'")
+                value = [value]
+            if len(value) > MAX_DISJUNCTION_VALUES:
+                raise QueryPlanError(f"'{op}' on '{field}' has {len(value)} values; Firestore allows {MAX_DISJUNCTION_VALUES}.")
+            value = [_coerce_value(v, fields[field], field, repairs) for v in value]
+        else:
+            value = _coerce_value(value, fields[field], field, repairs)
+        validated.append({"field": field, "operator": op, "value": value})
+    return validated
+
+
+def _validate_order_by(order_by, fields: dict, repairs: list[str]) -> list[dict]:
+    validated = []
+    for order in order_by or []:
+        if isinstance(order, str):
+            order = {"field": order}
+        field = _resolve_name(order.get("field"), list(fields), "field", repairs)
+        direction = str(order.get("direction", "ASCENDING")).upper()
+        direction = "DESCENDING" if direction.startswith("DESC") else "ASCENDING"
+        validated.append({"field": field, "direction": direction})
+    return validated
+
+
+# --- 3. Index and Cost Analysis ---
+def required_composite_index(collection: str, where: list[dict], order_by: list[dict]) -> tuple[str, ...] | None:
+    """
+    Returns the composite index fields a query shape needs, or None when
+    Firestore's automatic single-field indexes are enough.
+    """
+    equality_fields = sorted({c["field"] for c in where if c["operator"] in EQUALITY_OPERATORS})
+    inequality_fields = sorted({c["field"] for c in where if c["operator"] in INEQUALITY_OPERATORS})
+    order_fields = [o["field"] for o in order_by]
+
+    filter_fields = set(equality_fields) | set(inequality_fields)
+    needs_index = (
+        len(inequality_fields) > 1
+        or (equality_fields and set(inequality_fields) - set(equality_fields))
+        or len(order_fields) > 1
+        or (order_fields and filter_fields - {order_fields[0]})
+    )
+    if not needs_index:
+        return None
+    fields = equality_fields + [f for f in inequality_fields + order_fields if f not in equality_fields]
+    return tuple(dict.fromkeys(fields))
+
+
+def _has_index(collection: str, fields: tuple[str, ...]) -> bool:
+    """
+    An index serves the query if it covers the same fields and ends with the
+    same range/sort field; equality fields may come in any order.
+    """
+    if (collection, fields) in _missing_indexes:
+        return False
+    return any(
+        name == collection and set(index) == set(fields) and index[-1] == fields[-1]
+        for name, index in COMPOSITE_INDEXES
+    )
+
+
+def _estimate_matching(count: int, where: list[dict]) -> int:
+    fraction = 1.0
+    for condition in where:
+        op = condition["operator"]
+        if op in ("in", "array-contains-any"):
+            fraction *= min(1.0, 0.1 * len(condition["value"]))
+        else:
+            fraction *= _SELECTIVITY.get(op, _RANGE_SELECTIVITY)
+    return max(1, int(count * fraction))
+
+
+# --- 4. Per-Collection Validation ---
+def _validate_collection_query(
+    query_plan: dict,
+    schema: dict,
+    count_provider: Callable[[str], int] | None,
+    repairs: list[str],
+    bounded: bool = True,
+) -> tuple[dict, int]:
+    """
+    Validates the single-collection part of a plan and returns it with its
+    estimated reads. With bounded=False a missing limit means "all matching
+    documents", which joins and aggregations need to be correct.
+    """
+    collection = query_plan.get("collection")
+    if not collection:
+        raise QueryPlanError("The 'collection' field is missing from the query plan.")
+    collection = _resolve_name(collection, list(schema), "collection", repairs)
+    fields = schema[collection]["fields"]
+
+    select = []
+    for field in query_plan.get("select") or []:
+        try:
+            select.append(_resolve_name(field, list(fields), "field", repairs))
+        except QueryPlanError:
+            repairs.append(f"dropped unknown select field '{field}'")
+
+    where = _validate_conditions(query_plan.get("where"), fields, repairs)
+    order_by = _validate_order_by(query_plan.get("order_by"), fields, repairs)
+    if query_plan.get("limit") is not None:
+        limit = _normalize_limit(query_plan["limit"], repairs)
+    elif bounded:
+        repairs.append(f"added default limit {DEFAULT_LIMIT} on '{collection}'")
+        limit = DEFAULT_LIMIT
+    else:
+        limit = None
+
+    plan = {"collection": collection, "select": select, "where": where, "order_by": order_by, "limit": limit}
+    in_memory = {}
+
+    index = required_composite_index(collection, where, order_by)
+    if index and not _has_index(collection, index):
+        if required_composite_index(collection, where, []):
+            # Equality filters alone are served by Firestore's index merging, so
+            # keep those server-side (or a single inequality field if there are
+            # none) and apply the remaining filters in memory.
+            server_where = [c for c in where if c["operator"] in EQUALITY_OPERATORS]
+            if not server_where:
+                server_where = [c for c in where if c["field"] == where[0]["field"]]
+            plan["where"] = server_where
+            in_memory["where"] = [c for c in where if c not in server_where]
+        if order_by and required_composite_index(collection, plan["where"], order_by):
+            in_memory["order_by"] = order_by
+            plan["order_by"] = []
+        # Filtering or sorting in memory only works on the full matching set,
+        # so the limit has to move with it.
+        if in_memory and limit is not None:
+            in_memory["limit"] = limit
+            plan["limit"] = None
+        repairs.append(f"composite index {index} on '{collection}' not deployed; applying {sorted(in_memory)} in memory")
+
+    estimated_reads = plan["limit"] or MAX_ESTIMATED_READS
+    if count_provider is not None:
+        matching = _estimate_matching(count_provider(collection), plan["where"])
+        estimated_reads = matching if plan["limit"] is None else min(plan["limit"], matching)
+    if plan["limit"] is None:
+        # Hard stop on the unbounded scan in case the estimate was optimistic.
+        # One extra document is read so the executor can tell a scan that hit
+        # the cap (and would be sorted/filtered/aggregated while truncated)
+        # from one that happened to match exactly MAX_ESTIMATED_READS.
+        plan["limit"] = MAX_ESTIMATED_READS + 1
+        plan["scan_cap"] = MAX_ESTIMATED_READS
+
+    if in_memory:
+        plan["in_memory"] = in_memory
+    return plan, estimated_reads
+
+
+# --- 5. Join and Aggregate Stages ---
+AGGREGATE_FUNCTIONS = {"sum", "mean", "count", "min", "max", "nunique"}
+_AGGREGATE_ALIASES = {"avg": "mean", "average": "mean", "total": "sum", "distinct_count": "nunique"}
+
+# Join keys that must be canonicalized through a mapping collection first.
+JOIN_MAPPINGS = {"contractor": "contractor_name_mapping"}
+
+
+def _validate_join(join: dict, left_plan: dict, schema: dict, count_provider, repairs: list[str]) -> tuple[dict, int]:
+    if not isinstance(join, dict):
+        raise QueryPlanError(f"Malformed join stage: {join!r}")
+    right_plan, reads = _validate_collection_query(join, schema, count_provider, repairs, bounded=False)
+    left_fields = schema[left_plan["collection"]]["fields"]
+    right_fields = schema[right_plan["collection"]]["fields"]
+    shared = [f for f in left_fields if f in right_fields]
+    on = _resolve_name(join.get("on") or (shared[0] if shared else None), shared, "join field", repairs)
+
+    how = str(join.get("how", "inner")).lower()
+    if how not in ("inner", "left"):
+        raise QueryPlanError(f"Unsupported join type '{how}'. Use 'inner' or 'left'.")
+
+    right_aggregate = {}
+    for field, function in (join.get("aggregate") or {}).items():
+        field = _resolve_name(field, list(right_fields), "field", repairs)
+        right_aggregate[field] = _normalize_aggregate_function(function, repairs)
+
+    # Both sides must carry the key through their projections.
+    for side in (left_plan, right_plan):
+        if side["select"] and on not in side["select"]:
+            side["select"].append(on)
+    for field in right_aggregate:
+        if right_plan["select"] and field not in right_plan["select"]:
+            right_plan["select"].append(field)
+
+    right_plan.update({"on": on, "how": how, "via": JOIN_MAPPINGS.get(on), "aggregate": right_aggregate})
+    return right_plan, reads
+
+
+def _normalize_aggregate_function(function, repairs: list[str]) -> str:
+    name = str(function).strip().lower()
+    name = _AGGREGATE_ALIASES.get(name, name)
+    if name not in AGGREGATE_FUNCTIONS:
+        raise QueryPlanError(f"Unsupported aggregate function '{function}'.")
+    if name != function:
+        repairs.append(f"aggregate function '{function}' -> '{name}'")
+    return name
+
+
+def _validate_aggregate(aggregate: dict, columns: list[str], repairs: list[str]) -> dict:
+    if not isinstance(aggregate, dict):
+        raise QueryPlanError(f"Malformed aggregate stage: {aggregate!r}")
+    group_by = [_resolve_name(f, columns, "group_by field", repairs) for f in aggregate.get("group_by") or []]
+    metrics = []
+    for metric in aggregate.get("metrics") or []:
+        function = _normalize_aggregate_function(metric.get("function", "sum"), repairs)
+        field = _resolve_name(metric.get("field"), columns, "metric field", repairs)
+        metrics.append({"field": field, "function": function, "alias": metric.get("alias") or f"{function}_{field}"})
+    if not metrics:
+        raise QueryPlanError("The aggregate stage needs at least one metric.")
+
+    output_columns = group_by + [m["alias"] for m in metrics]
+    order_by = []
+    for order in aggregate.get("order_by") or []:
+        if isinstance(order, str):
+            order = {"field": order}
+        field = order.get("field")
+        if field not in output_columns:
+            # Ordering by a raw field usually means "by its aggregated metric".
+            alias = next((m["alias"] for m in metrics if m["field"] == field), None)
+            field = alias or _resolve_name(field, output_columns, "aggregate order_by field", repairs)
+        direction = "DESCENDING" if str(order.get("direction", "ASCENDING")).upper().startswith("DESC") else "ASCENDING"
+        order_by.append({"field": field, "direction": direction})
+
+    limit = aggregate.get("limit")
+    return {
+        "group_by": group_by,
+        "metrics": metrics,
+        "order_by": order_by,
+        "limit": _normalize_limit(limit, repairs) if limit is not None else None,
+    }
+
+
+# --- 6. Main Entry Point ---
+def validate_query_plan(
+    query_plan: dict,
+    schema: dict = FIRESTORE_SCHEMA,
+    count_provider: Callable[[str], int] | None = None,
+    enforce_budget: bool = True,
+) -> dict:
+    """
+    Validates and repairs a query plan against the schema.
+
+    Returns {"plan": repaired_plan, "repairs": [...], "estimated_reads": int}.
+    The repaired plan only contains what Firestore can serve with the deployed
+    indexes; anything else goes into plan["in_memory"] (where/order_by/limit)
+    to be applied to the fetched rows. Optional "join" and "aggregate" stages
+    are validated against the joined columns. Raises QueryPlanError when the
+    plan cannot be repaired or, unless enforce_budget is False, would exceed
+    MAX_ESTIMATED_READS.
+    """
+    if not isinstance(query_plan, dict) or not query_plan:
+        raise QueryPlanError("The query plan is empty or not a JSON object.")
+
+    repairs: list[str] = []
+    query_plan = dict(query_plan)
+    aggregate = query_plan.get("aggregate")
+    join = query_plan.get("join")
+
+    if aggregate and isinstance(aggregate, dict):
+        # A limit or sort on the raw rows would aggregate a truncated sample;
+        # the LLM almost always means "top N groups", so move them to the stage.
+        aggregate = dict(aggregate)
+        if query_plan.get("limit") is not None and aggregate.get("limit") is None:
+            aggregate["limit"] = query_plan["limit"]
+            repairs.append("moved limit to the aggregate stage")
+        if query_plan.get("order_by") and not aggregate.get("order_by"):
+            aggregate["order_by"] = query_plan["order_by"]
+            repairs.append("moved order_by to the aggregate stage")
+        query_plan["limit"] = None
+        query_plan["order_by"] = []
+
+    plan, estimated_reads = _validate_collection_query(
+        query_plan, schema, count_provider, repairs, bounded=not (join or aggregate)
+    )
+    columns = list(schema[plan["collection"]]["fields"])
+
+    if join:
+        plan["join"], join_reads = _validate_join(join, plan, schema, count_provider, repairs)
+        estimated_reads += join_reads
+        columns += [f for f in schema[plan["join"]["collection"]]["fields"] if f not in columns]
+
+    if aggregate:
+        derived = DERIVED_FIELDS.get(plan["collection"], {})
+        plan["aggregate"] = _validate_aggregate(aggregate, columns + list(derived), repairs)
+        needed = plan["aggregate"]["group_by"] + [m["field"] for m in plan["aggregate"]["metrics"]]
+        needed = [derived[f]["source"] if f in derived else f for f in needed]
+        for side in (plan, plan.get("join")):
+            if side and side["select"]:
+                side_fields = schema[side["collection"]]["fields"]
+                side["select"] += [f for f in needed if f in side_fields and f not in side["select"]]
+
+    for repair in repairs:
+        logging.info(f"Query plan repair: {repair}")
+    validation = {"plan": plan, "repairs": repairs, "estimated_reads": estimated_reads}
+    if enforce_budget:
+        check_read_budget(validation)
+    return validation
+
+
+def check_scan_cap(plan: dict, fetched: int):
+    """
+    Raises QueryPlanError if an unbounded scan came back with more than its
+    scan cap, i.e. the rows are a truncated sample of the matching documents.
+    """
+    cap = plan.get("scan_cap")
+    if cap is not None and fetched > cap:
+        raise QueryPlanError(
+            f"Query on '{plan['collection']}' matches more than {cap} documents, so its sort, filter, join "
+            f"or aggregation would run on a truncated set. Add a filter to narrow it down."
+        )
+
+
+def check_read_budget(validation: dict):
+    """Raises QueryPlanError if a validated plan would read more than MAX_ESTIMATED_READS documents."""
+    if validation["estimated_reads"] > MAX_ESTIMATED_READS:
+        raise QueryPlanError(
+            f"Query on '{validation['plan']['collection']}' would read about {validation['estimated_reads']} "
+            f"documents (maximum {MAX_ESTIMATED_READS}). Add a filter or a limit."
+        )
@@ -0,0 +1,215 @@
+# result_handle.py
+#
+# Keeps query results out of the agent state's memory footprint. Nodes pass a
+# ResultHandle instead of a DataFrame; frames over RESULT_SPILL_THRESHOLD_MB,
+# or any frame that would push resident results over the per-process
+# RESULT_MEMORY_BUDGET_MB, are written to an Arrow IPC file and read back
+# lazily through a memory map, so only the columns/rows a node asks for are
+# materialized.
+
+import os
+import uuid
+import logging
+import tempfile
+import threading
+import weakref
+from typing import Iterator
+import pandas as pd
+import pyarrow as pa
+
+import metrics
+
+SPILL_THRESHOLD_BYTES = int(float(os.getenv("RESULT_SPILL_THRESHOLD_MB", "32")) * 1024 * 1024)
+MEMORY_BUDGET_BYTES = int(float(os.getenv("RESULT_MEMORY_BUDGET_MB", "256")) * 1024 * 1024)
+SPILL_DIR = os.getenv("RESULT_SPILL_DIR", os.path.join(tempfile.gettempdir(), "floodgpt_results"))
+
+
+# --- 1. Resident Memory Budget ---
+class _ResidentTracker:
+    """Tracks in-memory handles and spills the largest ones when the budget is exceeded."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._handles = weakref.WeakSet()
+
+    def resident_bytes(self) -> int:
+        with self._lock:
+            return sum(h.nbytes for h in self._handles)
+
+    def admit(self, handle: "ResultHandle"):
+        with self._lock:
+            resident = sorted(self._handles, key=lambda h: h.nbytes, reverse=True)
+            total = sum(h.nbytes for h in resident)
+            to_spill = []
+            for other in resident:
+                if total + handle.nbytes <= MEMORY_BUDGET_BYTES:
+                    break
+                to_spill.append(other)
+                total -= other.nbytes
+            fits = total + handle.nbytes <= MEMORY_BUDGET_BYTES
+            if fits:
+                self._handles.add(handle)
+            for other in to_spill:
+                self._handles.discard(other)
+        # Whatever cannot be spilled stays resident and keeps counting.
+        for other in to_spill:
+            if not other.spill():
+                self._track(other)
+        if not fits and not handle.spill():
+            self._track(handle)
+        metrics.set_gauge("result_resident_bytes", self.resident_bytes())
+
+    def _track(self, handle: "ResultHandle"):
+        with self._lock:
+            self._handles.add(handle)
+
+    def forget(self, handle: "ResultHandle"):
+        with self._lock:
+            self._handles.discard(handle)
+
+
+_tracker = _ResidentTracker()
+
+
+def _to_arrow(df: pd.DataFrame) -> pa.Table:
+    """
+    Converts a frame to Arrow. Object columns Arrow cannot type (e.g. numbers
+    mixed with strings in one Firestore field) are written as strings.
+    """
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        mixed = {col: df[col].astype("string") for col in df.columns if df[col].dtype == object}
+        return pa.Table.from_pandas(df.assign(**mixed), preserve_index=False)
+
+
+def _remove_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+# --- 2. Result Handle ---
+class ResultHandle:
+    """
+    A query result that is either resident as a DataFrame or spilled to a
+    memory-mapped Arrow file. Read it with head(), iter_batches() or
+    to_frame(columns); to_frame() with no columns loads everything.
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        self._df = df
+        self._path = None
+        self._finalizer = None
+        self._unspillable = False
+        self.columns = [str(c) for c in df.columns]
+        self.num_rows = len(df)
+        self.nbytes = int(df.memory_usage(index=True, deep=True).sum())
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> "ResultHandle":
+        """Wraps a frame, spilling it right away if it is over the threshold or the budget."""
+        handle = cls(df)
+        if handle.nbytes <= SPILL_THRESHOLD_BYTES or not handle.spill():
+            _tracker.admit(handle)
+        return handle
+
+    @property
+    def empty(self) -> bool:
+        return self.num_rows == 0 or not self.columns
+
+    @property
+    def spilled(self) -> bool:
+        return self._path is not None
+
+    def spill(self) -> bool:
+        """
+        Writes the frame to an Arrow IPC file and drops the in-memory copy.
+        Returns False, keeping the frame resident, if it cannot be written.
+        """
+        df = self._df
+        if df is None:
+            return True
+        if self._unspillable:
+            return False
+        try:
+            table = _to_arrow(df)
+            os.makedirs(SPILL_DIR, exist_ok=True)
+            path = os.path.join(SPILL_DIR, f"{uuid.uuid4().hex}.arrow")
+            with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        except Exception as e:
+            self._unspillable = True
+            metrics.increment("result_spill_failures_total")
+            logging.warning(f"Could not spill a {self.num_rows}-row result, keeping it in memory: {e}")
+            return False
+        self._path = path
+        self._finalizer = weakref.finalize(self, _remove_file, path)
+        self._df = None
+        _tracker.forget(self)
+        metrics.increment("result_spills_total")
+        metrics.increment("result_spilled_bytes_total", self.nbytes)
+        logging.info(f"Spilled a {self.num_rows}-row result ({self.nbytes / 1e6:.1f} MB) to {path}.")
+        return True
+
+    def _open(self) -> pa.ipc.RecordBatchFileReader:
+        return pa.ipc.open_file(pa.memory_map(self._path, "r"))
+
+    def to_frame(self, columns: list[str] | None = None) -> pd.DataFrame:
+        """Materializes the result, or only the given columns of it."""
+        df = self._df  # read once; another thread may spill this handle concurrently
+        if df is not None:
+            return df if columns is None else df[columns]
+        table = self._open().read_all()
+        if columns is not None:
+            table = table.select(columns)
+        return table.to_pandas()
+
+    def head(self, n: int = 5) -> pd.DataFrame:
+        """Reads only the record batches needed for the first n rows."""
+        df = self._df
+        if df is not None:
+            return df.head(n)
+        reader = self._open()
+        batches, rows = [], 0
+        for i in range(reader.num_record_batches):
+            if rows >= n:
+                break
+            batch = reader.get_batch(i)
+            batches.append(batch)
+            rows += batch.num_rows
+        if not batches:
+            return pd.DataFrame(columns=self.columns)
+        return pa.Table.from_batches(batches).slice(0, n).to_pandas()
+
+    def iter_batches(self, columns: list[str] | None = None, batch_rows: int = 65536) -> Iterator[pd.DataFrame]:
+        """Yields the result as frames of at most batch_rows rows, one record batch in memory at a time."""
+        df = self._df
+        if df is not None:
+            df = df if columns is None else df[columns]
+            for start in range(0, max(len(df), 1), batch_rows):
+                yield df.iloc[start:start + batch_rows]
+            return
+        reader = self._open()
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            if columns is not None:
+                batch = batch.select(columns)
+            for start in range(0, max(batch.num_rows, 1), batch_rows):
+                yield batch.slice(start, batch_rows).to_pandas()
+
+    def __len__(self) -> int:
+        return self.num_rows
+
+    def __repr__(self) -> str:
+        where = f"spilled to {self._path}" if self.spilled else "in memory"
+        return f"ResultHandle({self.num_rows} rows x {len(self.columns)} columns, {where})"
+
+    # Handles cross process boundaries (e.g. the JSON encoding pool). A spilled
+    # handle travels as its path only, and copies never delete the file.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_finalizer"] = None
+        return state
+
@@ -0,0 +1,252 @@
+# rollups.py
+#
+# Pre-materialized aggregates of `flood_control_projects`, so the common
+# "cost by region / year / contractor" and "projects by status" questions
+# are answered from a handful of rollup documents instead of a full scan.
+#
+# Each rollup is a collection with one document per group, holding the
+# group value plus project_count, project_name_count and
+# <measure>_sum/_count/_min/_max for every measure. Groups and counts follow
+# the scan path (`apply_aggregate`): projects with no value for the dimension
+# form their own group, and counts are of non-null values. Every build writes a new versioned collection
+# (`rollup_by_region_v<built_at>`) and then points the rollup's `rollup_meta`
+# document at it, so readers switch from one complete version to the next and
+# never see a half-written rollup. The version before the previous one is
+# deleted, which leaves instances with a cached meta entry time to move over.
+# Rollups are rebuilt by sqlite_to_firestore.py after a migration, or
+# manually:
+#   python rollups.py
+
+import os
+import time
+import logging
+import threading
+import pandas as pd
+from google.cloud import firestore
+
+from query_stages import add_derived_fields
+
+SOURCE_COLLECTION = "flood_control_projects"
+META_COLLECTION = "rollup_meta"
+MEASURES = ["contract_cost", "abc"]
+
+# Rollup name -> grouping dimension.
+ROLLUPS = {
+    "rollup_by_region": "region",
+    "rollup_by_year": "year",
+    "rollup_by_contractor": "contractor",
+    "rollup_by_status": "status",
+    "rollup_by_implementing_office": "implementing_office",
+}
+
+ROLLUP_ROUTING_ENABLED = os.getenv("ROLLUP_ROUTING", "true").lower() == "true"
+META_CACHE_TTL_SECONDS = int(os.getenv("ROLLUP_META_CACHE_TTL", "600"))
+
+_ROLLUP_FUNCTIONS = {"sum", "count", "mean", "min", "max"}
+# Fields whose non-null count is stored as <field>_count. A count of any other
+# field cannot be answered from a rollup, since project_count includes nulls.
+_COUNTED_FIELDS = {"project_name", *MEASURES}
+
+
+# --- 1. Building ---
+def compute_rollup(df: pd.DataFrame, dimension: str) -> pd.DataFrame:
+    """Computes one rollup table from the raw project rows."""
+    measures = [m for m in MEASURES if m in df.columns]
+    numeric = df[measures].apply(pd.to_numeric, errors="coerce")
+    keys = df[dimension].rename(dimension)
+    stats = numeric.groupby(keys, dropna=False).agg(["sum", "count", "min", "max"])
+    stats.columns = [f"{measure}_{stat}" for measure, stat in stats.columns]
+    if "project_name" in df.columns:
+        stats["project_name_count"] = df["project_name"].groupby(keys, dropna=False).count()
+    stats["project_count"] = keys.groupby(keys, dropna=False).size()
+    return stats.reset_index()
+
+
+def _delete_collection(db, collection: str):
+    """Deletes every document of a collection in batches of 500."""
+    batch, pending = db.batch(), 0
+    for doc in db.collection(collection).list_documents():
+        batch.delete(doc)
+        pending += 1
+        if pending == 500:
+            batch.commit()
+            batch, pending = db.batch(), 0
+    if pending:
+        batch.commit()
+
+
+def _write_collection(db, collection: str, rows: list[dict]):
+    """Writes rows as new documents in batches of 500."""
+    batch = db.batch()
+    for count, row in enumerate(rows, start=1):
+        batch.set(db.collection(collection).document(), row)
+        if count % 500 == 0:
+            batch.commit()
+            batch = db.batch()
+    batch.commit()
+
+
+def build_rollups(db) -> dict[str, int]:
+    """Reads the source collection once and publishes a new version of every rollup. Returns rows per rollup."""
+    fields = sorted({"date_started", "project_name", *MEASURES, *(d for d in ROLLUPS.values() if d != "year")})
+    rows = [doc.to_dict() for doc in db.collection(SOURCE_COLLECTION).select(fields).stream()]
+    df = add_derived_fields(pd.DataFrame(rows, columns=fields), SOURCE_COLLECTION)
+
+    sizes = {}
+    built_at = time.time()
+    for name, dimension in ROLLUPS.items():
+        table = compute_rollup(df, dimension)
+        # Firestore rejects NumPy scalars, so write plain Python values.
+        records = [
+            {key: (value.item() if hasattr(value, "item") else value) for key, value in record.items()}
+            for record in table.astype(object).where(table.notna(), None).to_dict(orient="records")
+        ]
+        collection = f"{name}_v{int(built_at)}"
+        _write_collection(db, collection, records)
+
+        meta_ref = db.collection(META_COLLECTION).document(name)
+        old_meta = meta_ref.get().to_dict() or {}
+        meta_ref.set({
+            "dimension": dimension, "collection": collection, "previous": old_meta.get("collection", name),
+            "rows": len(records), "source_rows": len(df), "built_at": built_at,
+        })
+        stale = old_meta.get("previous")
+        if stale and stale != collection:
+            _delete_collection(db, stale)
+        sizes[name] = len(records)
+        logging.info(f"Published rollup '{name}' as '{collection}' with {len(records)} rows from {len(df)} projects.")
+
+    _clear_meta_cache()
+    return sizes
+
+
+# --- 2. Routing ---
+_meta_cache: tuple[float, dict[str, str]] | None = None
+_meta_lock = threading.Lock()
+
+
+def _clear_meta_cache():
+    global _meta_cache
+    with _meta_lock:
+        _meta_cache = None
+
+
+def available_rollups(db) -> dict[str, str]:
+    """Maps each built rollup to its current versioned collection, cached for META_CACHE_TTL_SECONDS."""
+    global _meta_cache
+    now = time.monotonic()
+    with _meta_lock:
+        if _meta_cache and now - _meta_cache[0] < META_CACHE_TTL_SECONDS:
+            return _meta_cache[1]
+    # Rollups built before versioning live in a collection named after the rollup.
+    collections = {doc.id: doc.to_dict().get("collection", doc.id) for doc in db.collection(META_COLLECTION).stream()}
+    with _meta_lock:
+        _meta_cache = (now, collections)
+    return collections
+
+
+def _rollup_column(metric: dict) -> str | None:
+    """Maps a validated aggregate metric to the rollup column that answers it."""
+    field, function = metric["field"], metric["function"]
+    if function == "count":
+        return f"{field}_count" if field in _COUNTED_FIELDS else None
+    if field in MEASURES and function in _ROLLUP_FUNCTIONS - {"mean"}:
+        return f"{field}_{function}"
+    return None
+
+
+def route_plan(plan: dict) -> dict | None:
+    """
+    Returns a rollup route for a validated plan, or None if the plan cannot
+    be answered from a rollup. A plan matches when it aggregates
+    flood_control_projects by exactly one rollup dimension, with no join and
+    no filters other than on that dimension.
+    """
+    if not ROLLUP_ROUTING_ENABLED or plan.get("collection") != SOURCE_COLLECTION or plan.get("join"):
+        return None
+    aggregate = plan.get("aggregate")
+    if not aggregate or len(aggregate["group_by"]) != 1:
+        return None
+    dimension = aggregate["group_by"][0]
+    name = next((n for n, d in ROLLUPS.items() if d == dimension), None)
+    if name is None:
+        return None
+
+    where = plan["where"] + plan.get("in_memory", {}).get("where", [])
+    if any(condition["field"] != dimension for condition in where):
+        return None
+
+    columns = {}
+    for metric in aggregate["metrics"]:
+        if metric["function"] == "mean" and metric["field"] in MEASURES:
+            # Mean is recomputed from the stored sum and count.
+            columns[metric["alias"]] = (f"{metric['field']}_sum", f"{metric['field']}_count")
+            continue
+        column = _rollup_column(metric)
+        if column is None:
+            return None
+        columns[metric["alias"]] = column
+    return {"rollup": name, "dimension": dimension, "where": where, "columns": columns, "aggregate": aggregate}
+
+
+def query_rollup(db, route: dict) -> pd.DataFrame | None:
+    """
+    Answers a routed plan from its rollup collection. Returns None if that
+    rollup has not been built yet, its collection is gone, or it predates a
+    column the route needs, so the caller falls back to a scan.
+    """
+    collection = available_rollups(db).get(route["rollup"])
+    if collection is None:
+        return None
+
+    query = db.collection(collection)
+    for condition in route["where"]:
+        query = query.where(condition["field"], condition["operator"], condition["value"])
+
+    aggregate = route["aggregate"]
+    order_by = aggregate.get("order_by", [])
+    if len(order_by) == 1 and isinstance(route["columns"].get(order_by[0]["field"]), str) and not route["where"]:
+        # A single stored column sorts server-side, so a top-N reads only N documents.
+        direction = firestore.Query.DESCENDING if order_by[0]["direction"] == "DESCENDING" else firestore.Query.ASCENDING
+        query = query.order_by(route["columns"][order_by[0]["field"]], direction=direction)
+        if aggregate.get("limit"):
+            query = query.limit(aggregate["limit"])
+
+    rows = [doc.to_dict() for doc in query.stream()]
+    dimension = route["dimension"]
+    if not rows:
+        if not route["where"]:
+            # An unfiltered rollup always has documents, so the cached version was deleted by a rebuild.
+            logging.warning(f"Rollup collection '{collection}' is empty or gone; falling back to a scan.")
+            _clear_meta_cache()
+            return None
+        return pd.DataFrame(columns=[dimension, *route["columns"]])
+
+    table = pd.DataFrame(rows)
+    needed = {c for column in route["columns"].values() for c in (column if isinstance(column, tuple) else (column,))}
+    if not needed <= set(table.columns):
+        logging.warning(f"Rollup collection '{collection}' lacks {sorted(needed - set(table.columns))}; falling back to a scan.")
+        return None
+    result = pd.DataFrame({dimension: table[dimension]})
+    for alias, column in route["columns"].items():
+        if isinstance(column, tuple):
+            total, count = column
+            result[alias] = table[total] / table[count].where(table[count] > 0)
+        else:
+            result[alias] = table[column]
+
+    if order_by:
+        result = result.sort_values(
+            [o["field"] for o in order_by],
+            ascending=[o["direction"] != "DESCENDING" for o in order_by],
+        )
+    if aggregate.get("limit"):
+        result = result.head(aggregate["limit"])
+    logging.info(f"Answered plan from rollup '{collection}' with {len(rows)} document reads.")
+    return result.reset_index(drop=True)
+
+
+# --- 3. Command-Line Entry Point ---
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    print(build_rollups(firestore.Client()))
@@ -28,3 +28,11 @@ FIRESTORE_SCHEMA = {
         }
     }
 }
+
+# Fields computed from stored fields at query time. They can be used in an
+# aggregate stage's group_by and are materialized in the rollup collections.
+DERIVED_FIELDS = {
+    "flood_control_projects": {
+        "year": {"source": "date_started", "transform": "year"},
+    }
+}
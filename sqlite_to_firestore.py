@@ -16,6 +16,9 @@
 import sqlite3
 from google.cloud import firestore
 
+from value_index import build_value_index
+from rollups import build_rollups
+
 # --- Configuration ---
 # Replace with your Google Cloud project ID
 PROJECT_ID = "my-gen-cli-ultrenz"
@@ -96,6 +99,14 @@ def migrate_to_firestore():
 
             print(f"Successfully migrated {len(data)} documents to collection '{table_name}'.")
 
+        # Refresh the where-value index so the agent snaps to the new data.
+        print("Rebuilding the value index...")
+        build_value_index(db)
+
+        # Re-materialize the aggregate rollups the planner routes to.
+        print("Rebuilding rollup collections...")
+        build_rollups(db)
+
     except sqlite3.Error as e:
         print(f"SQLite error: {e}")
     except Exception as e:
@@ -0,0 +1,107 @@
+# test_llm_routing.py
+#
+# Drives ModelRouter with langchain's fake chat model, so routing, failover
+# and hedging are checked without calling the Gemini API.
+#   python -m pytest test_llm_routing.py
+
+import time
+
+import pytest
+from langchain_core.language_models import FakeListChatModel
+
+import metrics
+from llm_config import DEFAULT_ROUTING_POLICY, ModelRouter, estimate_complexity
+
+
+class FailingChatModel(FakeListChatModel):
+    def _call(self, *args, **kwargs):
+        raise RuntimeError("model unavailable")
+
+
+class SlowChatModel(FakeListChatModel):
+    delay: float = 0.5
+
+    def _call(self, *args, **kwargs):
+        time.sleep(self.delay)
+        return super()._call(*args, **kwargs)
+
+
+def fake_factory(model_name: str, **kwargs):
+    """Fake models that answer with their own name; 'down-*' ones fail and 'slow-*' ones take 0.5s."""
+    if model_name.startswith("down"):
+        return FailingChatModel(responses=[model_name])
+    if model_name.startswith("slow"):
+        return SlowChatModel(responses=[model_name])
+    return FakeListChatModel(responses=[model_name])
+
+
+def make_router(tasks: dict, **overrides) -> ModelRouter:
+    policy = {**DEFAULT_ROUTING_POLICY, "tasks": tasks, "min_samples": 2, "cooldown_seconds": 60.0, **overrides}
+    return ModelRouter(policy, llm_factory=fake_factory)
+
+
+def counter(name: str, **labels) -> float:
+    key = name + "{" + ",".join(f"{k}={v}" for k, v in sorted(labels.items())) + "}"
+    return metrics.snapshot()["counters"].get(key, 0)
+
+
+def test_routes_by_task_and_complexity():
+    router = make_router({
+        "planning": {"simple": ["lite"], "complex": ["flash"]},
+        "insight": {"simple": ["pro"], "complex": ["pro"]},
+    })
+    assert router.invoke("planning", "q", complexity="simple").content == "lite"
+    assert router.invoke("planning", "q", complexity="complex").content == "flash"
+    assert router.invoke("insight", "q").content == "pro"
+    assert counter("llm_route_total", task="planning", complexity="complex", model="flash", reason="primary") >= 1
+
+
+def test_estimate_complexity():
+    assert estimate_complexity("Top 10 projects by cost") == "simple"
+    assert estimate_complexity("Compare the cost trend between regions and why it changed") == "complex"
+
+
+def test_fails_over_on_error_and_skips_unhealthy_model():
+    router = make_router({"planning": {"simple": ["down-a", "backup-a"]}})
+    # Each failure falls through to the secondary within the same call.
+    for _ in range(2):
+        assert router.invoke("planning", "q").content == "backup-a"
+    # After min_samples errors the primary is marked unhealthy and skipped entirely.
+    assert router.route("planning", "simple")[0] == "backup-a"
+    assert router.invoke("planning", "q").content == "backup-a"
+    assert counter("llm_errors_total", model="down-a") == 2
+    assert counter("llm_route_total", task="planning", complexity="simple", model="backup-a", reason="failover") >= 1
+
+
+def test_raises_when_every_model_fails():
+    router = make_router({"planning": {"simple": ["down-b", "down-c"]}})
+    with pytest.raises(RuntimeError):
+        router.invoke("planning", "q")
+
+
+def test_hedges_slow_primary_with_secondary():
+    router = make_router({"planning": {"simple": ["slow-a", "quick-a"]}}, hedge_p95_seconds=0.1, failover_p95_seconds=10.0)
+    # The first call gives the primary a latency history whose p95 exceeds the hedge threshold.
+    assert router.invoke("planning", "q").content == "slow-a"
+    start = time.perf_counter()
+    assert router.invoke("planning", "q").content == "quick-a"
+    assert time.perf_counter() - start < 0.4
+    assert counter("llm_hedges_total", task="planning", model="quick-a") == 1
+
+
+def test_skips_hedge_when_no_slot_is_free():
+    router = make_router({"planning": {"simple": ["slow-b", "quick-b"]}}, hedge_p95_seconds=0.1,
+                         failover_p95_seconds=10.0, max_concurrent_hedges=1)
+    router.invoke("planning", "q")
+    router._hedge_slots.acquire()
+    try:
+        assert router.invoke("planning", "q").content == "slow-b"
+    finally:
+        router._hedge_slots.release()
+    assert counter("llm_hedges_skipped_total", task="planning", model="quick-b") == 1
+
+
+def test_drops_unsupported_models_from_policy():
+    policy = {**DEFAULT_ROUTING_POLICY, "tasks": {"planning": {"simple": ["retired-model", "lite", "lite"]}}}
+    router = ModelRouter(policy, llm_factory=fake_factory, supported_models=["lite"])
+    assert router.policy["tasks"]["planning"]["simple"] == ["lite"]
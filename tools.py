@@ -1,14 +1,26 @@
+import os
 import logging
 import pandas as pd
 import json
+from typing import Callable, Iterator
 from google.cloud import firestore
+from google.api_core.exceptions import FailedPrecondition
 
 # LangChain and Google AI libraries
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 
 # The safe LLM factory function
-from llm_config import get_llm
+from llm_config import get_routed_llm
+from prompt_builder import TOKEN_BUDGETS, build_data_summary, build_schema_prompt
+from query_validator import (
+    check_read_budget, check_scan_cap, get_collection_count, mark_index_missing, required_composite_index, validate_query_plan,
+)
+from query_stages import add_derived_fields, apply_aggregate, get_name_mapping, hash_join
+from value_index import resolve_plan_values
+from rollups import query_rollup, route_plan
+from schema import FIRESTORE_SCHEMA
+from result_handle import ResultHandle
 
 # --- 1. FIRESTORE QUERY PLAN GENERATION ---
 def generate_firestore_query_plan(question: str, schema: dict) -> dict:
@@ -22,7 +34,7 @@ def generate_firestore_query_plan(question: str, schema: dict) -> dict:
         """
         You are an expert Firestore database engineer. Your task is to convert a user's question into a structured query plan for Firestore.
 
-        Given the following Firestore schema:
+        Given the following Firestore schema (one collection per line, as collection(field:type, ...)):
         ---
         {schema}
         ---
@@ -55,14 +67,23 @@ def generate_firestore_query_plan(question: str, schema: dict) -> dict:
         - "order_by" is a list of fields to sort the results by.
         - "limit" is the maximum number of documents to return.
 
+        Two optional stages are available when one collection is not enough:
+        - "join": {{"collection": "cpes_projects", "on": "contractor", "where": [...], "select": [...], "aggregate": {{"cpes_rating": "mean"}}}}
+          joins a second collection on a shared field. Contractor names are matched through contractor_name_mapping automatically.
+          "aggregate" reduces the joined collection to one row per key first; use it to avoid duplicating rows.
+        - "aggregate": {{"group_by": ["field"], "metrics": [{{"field": "contract_cost", "function": "sum", "alias": "total_cost"}}], "order_by": [...], "limit": 5}}
+          groups the (joined) rows. Functions: sum, mean, count, min, max, nunique.
+          flood_control_projects also has a derived "year" field (from date_started) usable in group_by.
+          Use it for totals, averages and counts instead of returning raw documents.
+
         Only respond with the JSON object.
         """
     )
 
-    llm = get_llm(model_name="gemini-1.5-flash", temperature=0)
+    llm = get_routed_llm("planning", question=question, temperature=0)
     chain = prompt | llm | StrOutputParser()
 
-    response_str = chain.invoke({"schema": json.dumps(schema, indent=2), "question": question})
+    response_str = chain.invoke({"schema": build_schema_prompt(schema), "question": question})
     clean_response_str = response_str.strip().replace('`json', '').replace('`', '')
     
     try:
@@ -70,58 +91,176 @@ def generate_firestore_query_plan(question: str, schema: dict) -> dict:
         return query_plan
     except json.JSONDecodeError:
         logging.error(f"Failed to decode JSON from query plan response: {clean_response_str}")
-        return {{}}
+        return {}
 
 # --- 2. FIRESTORE QUERY EXECUTION ---
-def execute_firestore_query(query_plan: dict) -> dict:
+_IN_MEMORY_OPERATORS = {
+    "==": lambda col, v: col == v,
+    "!=": lambda col, v: col != v,
+    "<": lambda col, v: col < v,
+    "<=": lambda col, v: col <= v,
+    ">": lambda col, v: col > v,
+    ">=": lambda col, v: col >= v,
+    "in": lambda col, v: col.isin(v),
+    "not-in": lambda col, v: ~col.isin(v),
+    "array-contains": lambda col, v: col.map(lambda x: isinstance(x, list) and v in x),
+    "array-contains-any": lambda col, v: col.map(lambda x: isinstance(x, list) and any(i in x for i in v)),
+}
+
+def _apply_in_memory_stage(df: pd.DataFrame, stage: dict) -> pd.DataFrame:
+    """Applies the filters, sort and limit the validator moved out of Firestore."""
+    for condition in stage.get("where", []):
+        if condition["field"] not in df.columns:
+            return df.iloc[0:0]
+        df = df[_IN_MEMORY_OPERATORS[condition["operator"]](df[condition["field"]], condition["value"])]
+    order_by = [o for o in stage.get("order_by", []) if o["field"] in df.columns]
+    if order_by:
+        df = df.sort_values(
+            [o["field"] for o in order_by],
+            ascending=[o["direction"] != "DESCENDING" for o in order_by],
+        )
+    if stage.get("limit"):
+        df = df.head(stage["limit"])
+    return df.reset_index(drop=True)
+
+# Rows per streamed chunk. The first chunk is smaller so the first rows show up quickly.
+ROW_CHUNK_SIZE = int(os.getenv("ROW_CHUNK_SIZE", "500"))
+FIRST_ROW_CHUNK_SIZE = int(os.getenv("FIRST_ROW_CHUNK_SIZE", "25"))
+
+def _stream_collection_rows(db, plan: dict) -> Iterator[list[dict]]:
+    """Runs the Firestore part of a validated plan and yields documents in chunks as they arrive."""
+    query = db.collection(plan["collection"])
+
+    # Apply where clauses
+    for condition in plan["where"]:
+        query = query.where(condition["field"], condition["operator"], condition["value"])
+
+    # Apply order_by clauses
+    for order in plan["order_by"]:
+        direction = firestore.Query.DESCENDING if order.get("direction") == "DESCENDING" else firestore.Query.ASCENDING
+        query = query.order_by(order["field"], direction=direction)
+
+    # Apply limit
+    query = query.limit(plan["limit"])
+
+    # Execute the query
+    chunk = []
+    chunk_size = FIRST_ROW_CHUNK_SIZE
+    for doc in query.stream():
+        chunk.append(doc.to_dict())
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+            chunk_size = ROW_CHUNK_SIZE
+    if chunk:
+        yield chunk
+
+def _to_split_chunk(rows: list[dict], columns: list[str]) -> dict:
+    """Converts row dicts to the 'split' layout the UI table uses (columns + data)."""
+    return {"columns": columns, "data": [[row.get(col) for col in columns] for row in rows]}
+
+def _run_collection_query(db, plan: dict, on_rows_chunk: Callable[[dict], None] | None = None) -> pd.DataFrame:
+    """
+    Runs the single-collection part of a validated plan and applies its
+    in-memory stage. If on_rows_chunk is given and the rows need no further
+    processing, each chunk is also passed to it as soon as it arrives.
+    """
+    streamable = on_rows_chunk is not None and "in_memory" not in plan
+    # Every chunk carries the same columns, so a field missing from the first
+    # chunk's documents still gets a column in the UI table.
+    columns = plan["select"] or list(FIRESTORE_SCHEMA[plan["collection"]]["fields"])
+    frames, fetched = [], 0
+    for chunk in _stream_collection_rows(db, plan):
+        fetched += len(chunk)
+        check_scan_cap(plan, fetched)
+        if streamable:
+            on_rows_chunk(_to_split_chunk(chunk, columns))
+        # Convert each chunk on arrival, so its row dicts are freed before the
+        # next chunk is read rather than held until the stream ends.
+        frames.append(pd.DataFrame(chunk))
+
+    if not frames:
+        return pd.DataFrame()
+
+    df = pd.concat(frames, ignore_index=True)
+    del frames
+
+    if "in_memory" in plan:
+        df = _apply_in_memory_stage(df, plan["in_memory"])
+
+    # Apply select fields
+    if plan["select"]:
+        df = df[[field for field in plan["select"] if field in df.columns]]
+
+    return df
+
+def execute_firestore_query(query_plan: dict, on_rows_chunk: Callable[[dict], None] | None = None) -> dict:
     """
-    Executes a Firestore query based on the provided query plan
-    and returns the results as a Pandas DataFrame.
+    Validates a Firestore query plan, executes it and returns the results as
+    a ResultHandle together with the repaired plan that actually ran.
+    Plans with a "join" stage read both collections with their own filters
+    pushed down, then hash-join them in memory; an "aggregate" stage runs last,
+    unless the plan can be answered from a pre-built rollup collection.
+
+    For plain single-collection plans, on_rows_chunk receives the rows in
+    {"columns", "data"} chunks while the Firestore stream is still open.
+    The returned result is always complete.
     """
     logging.info(f"Executing Firestore query plan: {query_plan}")
 
     try:
         db = firestore.Client()
-        collection_name = query_plan.get("collection")
-        if not collection_name:
-            raise ValueError("The 'collection' field is missing from the query plan.")
-
-        query = db.collection(collection_name)
-
-        # Apply where clauses
-        if "where" in query_plan and query_plan["where"]:
-            for condition in query_plan["where"]:
-                query = query.where(condition["field"], condition["operator"], condition["value"])
+        try:
+            return _execute_plan(db, query_plan, on_rows_chunk)
+        except FailedPrecondition as e:
+            # The plan relied on a composite index Firestore says is not
+            # deployed; record it as missing so validation moves that sort or
+            # filter into memory, and run the plan once more.
+            logging.warning(f"Firestore rejected the query for a missing index: {e}")
+            plan = validate_query_plan(query_plan, enforce_budget=False)["plan"]
+            for side in (plan, plan.get("join")):
+                index = side and required_composite_index(side["collection"], side["where"], side["order_by"])
+                if index:
+                    mark_index_missing(side["collection"], index)
+            return _execute_plan(db, query_plan, on_rows_chunk)
 
-        # Apply order_by clauses
-        if "order_by" in query_plan and query_plan["order_by"]:
-            for order in query_plan["order_by"]:
-                direction = firestore.Query.DESCENDING if order.get("direction") == "DESCENDING" else firestore.Query.ASCENDING
-                query = query.order_by(order["field"], direction=direction)
+    except Exception as e:
+        logging.error(f"Firestore query execution failed: {e}")
+        return {"sql_dataframe": ResultHandle.from_frame(pd.DataFrame()), "error": str(e)}
 
-        # Apply limit
-        if "limit" in query_plan:
-            query = query.limit(query_plan["limit"])
+def _execute_plan(db, query_plan: dict, on_rows_chunk: Callable[[dict], None] | None) -> dict:
+    """Validates, routes and runs one query plan; see execute_firestore_query."""
+    validation = validate_query_plan(
+        query_plan, count_provider=lambda c: get_collection_count(db, c), enforce_budget=False
+    )
+    query_plan, _ = resolve_plan_values(validation["plan"], db)
 
-        # Execute the query
-        docs = query.stream()
-        data = [doc.to_dict() for doc in docs]
+    # Aggregates over a rollup dimension are served from the rollup collection.
+    route = route_plan(query_plan)
+    if route:
+        df = query_rollup(db, route)
+        if df is not None:
+            return {"sql_dataframe": ResultHandle.from_frame(df), "firestore_query_plan": {**query_plan, "rollup": route["rollup"]}}
 
-        if not data:
-            return {"sql_dataframe": pd.DataFrame()}
+    check_read_budget(validation)
+    logging.info(f"Validated plan (~{validation['estimated_reads']} reads): {query_plan}")
 
-        # Convert to DataFrame
-        df = pd.DataFrame(data)
+    # Joined or aggregated rows only exist once every document is in.
+    streamable = not (query_plan.get("join") or query_plan.get("aggregate"))
+    df = _run_collection_query(db, query_plan, on_rows_chunk if streamable else None)
 
-        # Apply select fields
-        if "select" in query_plan and query_plan["select"]:
-            df = df[query_plan["select"]]
+    join = query_plan.get("join")
+    if join:
+        mapping = get_name_mapping(db, join["via"]) if join["via"] else None
+        # The right side is passed straight through so hash_join holds its only
+        # reference and can free it once reduced; df drops the left on return.
+        df = hash_join(df, _run_collection_query(db, join), join, mapping)
 
-        return {"sql_dataframe": df}
+    if query_plan.get("aggregate") and not df.empty:
+        df = add_derived_fields(df, query_plan["collection"])
+        df = apply_aggregate(df, query_plan["aggregate"])
 
-    except Exception as e:
-        logging.error(f"Firestore query execution failed: {e}")
-        return {"sql_dataframe": pd.DataFrame(), "error": str(e)}
+    return {"sql_dataframe": ResultHandle.from_frame(df), "firestore_query_plan": query_plan}
 
 
 # --- 4. VISUALIZATION RECOMMENDATION FUNCTION ---
@@ -134,7 +273,7 @@ You are an AI assistant that recommends appropriate data visualizations. Based o
 **Analyze the following information:**
 
 1.  **User's Question:** "{question}"
-2.  **Query Result Summary (Column Names and First 3 Rows):**
+2.  **Query Result Summary (Column Profile and Leading Rows):**
     ---
     {data_summary}
     ---
@@ -146,17 +285,17 @@ Recommended Visualization: [Chart type or "None"]
 Reason: [Brief explanation for your recommendation]
 """
 
-def recommend_visualization(user_question: str, sql_result_df: pd.DataFrame) -> str:
-    """Recommends a data visualization based on the user's question and a DataFrame."""
+def recommend_visualization(user_question: str, sql_result_df: pd.DataFrame | ResultHandle) -> str:
+    """Recommends a data visualization based on the user's question and a query result."""
     logging.info("Generating visualization recommendation...")
     try:
         if sql_result_df.empty:
             return "Recommended Visualization: none\nReason: The query returned no data to visualize."
             
-        data_summary = f"Columns: {', '.join(sql_result_df.columns)}\n\n{sql_result_df.head(3).to_string()}"
+        data_summary = build_data_summary(sql_result_df, TOKEN_BUDGETS["visualization"])
 
         prompt = ChatPromptTemplate.from_template(VISUALIZATION_PROMPT)
-        viz_llm = get_llm(model_name="gemini-1.5-flash", temperature=0)
+        viz_llm = get_routed_llm("visualization", question=user_question, temperature=0)
         chain = prompt | viz_llm | StrOutputParser()
         
         response = chain.invoke({"question": user_question, "data_summary": data_summary})
@@ -167,7 +306,7 @@ def recommend_visualization(user_question: str, sql_result_df: pd.DataFrame) ->
         return "Recommended Visualization: none\nReason: An error occurred while processing the data for visualization."
 
 # --- 5. INSIGHT GENERATION FUNCTION ---
-def generate_insight_from_data(question: str, df: pd.DataFrame) -> str:
+def generate_insight_from_data(question: str, df: pd.DataFrame | ResultHandle) -> str:
     """Generates a human-friendly insight from the data."""
     logging.info("Generating insight from data...")
 
@@ -180,7 +319,7 @@ def generate_insight_from_data(question: str, df: pd.DataFrame) -> str:
         The user asked the following question:
         "{question}"
         
-        The query returned the following data:
+        The query returned the following data (a profile of every column, then the leading rows):
         ---
         {data_summary}
         ---
@@ -191,10 +330,10 @@ def generate_insight_from_data(question: str, df: pd.DataFrame) -> str:
         """
     )
 
-    llm = get_llm(model_name="gemini-1.5-flash", temperature=0.7)
+    llm = get_routed_llm("insight", question=question, temperature=0.7)
     chain = prompt | llm | StrOutputParser()
 
-    data_summary = f"Columns: {', '.join(df.columns)}\n\n{df.head().to_string()}"
+    data_summary = build_data_summary(df, TOKEN_BUDGETS["insight"])
     
     insight = chain.invoke({"question": question, "data_summary": data_summary})
     return insight
\ No newline at end of file
@@ -0,0 +1,282 @@
+# value_index.py
+#
+# Index of the distinct values stored in low-cardinality string fields, used
+# to snap LLM-generated `where` values ("region 3", "ACME CONSTRUCTION INC.")
+# to the exact spelling in Firestore ("Region III", "Acme Construction")
+# before the query runs, so equality filters do not come back empty.
+#
+# The index is built by scanning the fields once and stored in the
+# `value_index` collection (one small document per field). It is rebuilt by
+# the migration script whenever the data is synced, or manually:
+#   python value_index.py
+# Serving instances load it from Firestore and refresh it every
+# VALUE_INDEX_TTL seconds; they never build it inside a request.
+
+import os
+import re
+import time
+import logging
+import threading
+from collections import defaultdict
+from google.cloud import firestore
+
+# Fields to index, per collection.
+INDEXED_FIELDS = {
+    "flood_control_projects": ["region", "status", "implementing_office", "contractor"],
+}
+
+INDEX_COLLECTION = "value_index"
+INDEX_TTL_SECONDS = int(os.getenv("VALUE_INDEX_TTL", "600"))
+# Minimum trigram similarity (Jaccard) for a fuzzy match to be accepted.
+FUZZY_THRESHOLD = float(os.getenv("VALUE_INDEX_FUZZY_THRESHOLD", "0.5"))
+# A fuzzy match is rejected when the runner-up scores within this margin of it
+# ("Region 4" is as close to "Region IV-A" as to "Region IV-B").
+FUZZY_MARGIN = float(os.getenv("VALUE_INDEX_FUZZY_MARGIN", "0.05"))
+
+_LEGAL_SUFFIXES = {"inc", "incorporated", "corp", "corporation", "co", "company", "ltd", "limited", "llc"}
+_ROMAN = ["", "i", "ii", "iii", "iv", "v", "vi", "vii", "viii", "ix", "x",
+          "xi", "xii", "xiii", "xiv", "xv", "xvi", "xvii", "xviii", "xix", "xx"]
+
+
+# --- 1. Normalization ---
+def normalize_value(value: str) -> str:
+    """
+    Case-folds, strips punctuation and legal suffixes, and writes small
+    numbers as roman numerals, so "Region 3" and "REGION III" normalize alike.
+    """
+    text = value.casefold().replace("&", " and ")
+    tokens = re.sub(r"[^\w\s]", " ", text).split()
+    numbered = []
+    for token in tokens:
+        # "3" -> "iii", "4a" -> "iv a"
+        match = re.fullmatch(r"(\d+)([a-z]?)", token)
+        if match and 0 < int(match.group(1)) < len(_ROMAN):
+            numbered.append(_ROMAN[int(match.group(1))])
+            if match.group(2):
+                numbered.append(match.group(2))
+        else:
+            numbered.append(token)
+    tokens = numbered
+    while len(tokens) > 1 and tokens[-1] in _LEGAL_SUFFIXES:
+        tokens.pop()
+    return " ".join(tokens)
+
+
+def _trigrams(text: str) -> set[str]:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+# --- 2. Per-Field Lookup ---
+class FieldValueIndex:
+    """Exact normalized and acronym lookup plus a trigram inverted index for fuzzy matches."""
+
+    def __init__(self, values: list[str]):
+        self.values = sorted(set(values))
+        self._exact = set(self.values)
+        self._by_normalized = {}
+        acronyms = defaultdict(set)
+        self._trigram_postings = defaultdict(set)
+        self._trigram_counts = []
+        for i, value in enumerate(self.values):
+            normalized = normalize_value(value)
+            self._by_normalized.setdefault(normalized, value)
+            words = normalized.split()
+            if len(words) > 1:
+                acronyms["".join(w[0] for w in words)].add(value)
+            grams = _trigrams(normalized)
+            self._trigram_counts.append(len(grams))
+            for gram in grams:
+                self._trigram_postings[gram].add(i)
+        # Only unambiguous acronyms ("ncr" -> "National Capital Region") are kept.
+        self._by_acronym = {acronym: next(iter(matches)) for acronym, matches in acronyms.items() if len(matches) == 1}
+
+    def resolve_exact(self, value: str) -> str | None:
+        """Returns the stored value matching `value` exactly, after normalization, or as an acronym."""
+        if value in self._exact:
+            return value
+        normalized = normalize_value(value)
+        if normalized in self._by_normalized:
+            return self._by_normalized[normalized]
+        return self._by_acronym.get(normalized)
+
+    def resolve(self, value: str) -> str | None:
+        """
+        Returns the canonical stored value for `value`, or None if nothing is
+        close enough or two stored values are about equally close.
+        """
+        match = self.resolve_exact(value)
+        if match is not None:
+            return match
+
+        normalized = normalize_value(value)
+        grams = _trigrams(normalized)
+        overlaps = defaultdict(int)
+        for gram in grams:
+            for i in self._trigram_postings.get(gram, ()):
+                overlaps[i] += 1
+        scores = sorted(
+            ((shared / (len(grams) + self._trigram_counts[i] - shared), i) for i, shared in overlaps.items()),
+            reverse=True,
+        )
+        if not scores or scores[0][0] < FUZZY_THRESHOLD:
+            return None
+        if len(scores) > 1 and scores[0][0] - scores[1][0] < FUZZY_MARGIN:
+            logging.info(f"Ambiguous value '{value}': '{self.values[scores[0][1]]}' and '{self.values[scores[1][1]]}' score alike.")
+            return None
+        return self.values[scores[0][1]]
+
+
+# --- 3. Building, Saving and Loading ---
+def _document_id(collection: str, field: str) -> str:
+    return f"{collection}.{field}"
+
+
+def build_value_index(db) -> dict:
+    """Scans the indexed fields in Firestore and stores their distinct values in INDEX_COLLECTION."""
+    collections = {}
+    built_at = time.time()
+    for collection, fields in INDEXED_FIELDS.items():
+        distinct = {field: set() for field in fields}
+        # Projection keeps the payload small; Firestore still bills one read per document.
+        for doc in db.collection(collection).select(fields).stream():
+            row = doc.to_dict()
+            for field in fields:
+                value = row.get(field)
+                if isinstance(value, str) and value.strip():
+                    distinct[field].add(value)
+        collections[collection] = {field: sorted(values) for field, values in distinct.items()}
+        logging.info(f"Indexed distinct values for '{collection}': " + ", ".join(f"{f}={len(v)}" for f, v in distinct.items()))
+
+    batch = db.batch()
+    for collection, fields in collections.items():
+        for field, values in fields.items():
+            batch.set(
+                db.collection(INDEX_COLLECTION).document(_document_id(collection, field)),
+                {"collection": collection, "field": field, "values": values, "built_at": built_at},
+            )
+    batch.commit()
+    _set_index(collections)
+    return collections
+
+
+_index: dict[str, dict[str, FieldValueIndex]] | None = None
+_loaded_at: float | None = None
+_index_lock = threading.Lock()
+_refresh_lock = threading.Lock()
+
+
+def _set_index(collections: dict):
+    global _index, _loaded_at
+    built = {
+        collection: {field: FieldValueIndex(values) for field, values in fields.items()}
+        for collection, fields in collections.items()
+    }
+    with _index_lock:
+        _index = built
+        _loaded_at = time.monotonic()
+
+
+def _load_index(db) -> dict:
+    """Reads the stored index documents (one read per indexed field)."""
+    collections = defaultdict(dict)
+    for doc in db.collection(INDEX_COLLECTION).stream():
+        data = doc.to_dict()
+        collections[data["collection"]][data["field"]] = data.get("values", [])
+    return dict(collections)
+
+
+def get_value_index(db=None) -> dict[str, dict[str, FieldValueIndex]]:
+    """
+    Returns the in-process index, reloading it from INDEX_COLLECTION once it
+    is older than INDEX_TTL_SECONDS. Only one thread reloads at a time; the
+    others keep using the current copy. If nothing has been stored yet the
+    index is empty and values pass through unchanged.
+    """
+    global _loaded_at
+    with _index_lock:
+        fresh = _loaded_at is not None and time.monotonic() - _loaded_at < INDEX_TTL_SECONDS
+        current = _index
+    if fresh or not _refresh_lock.acquire(blocking=current is None):
+        return current or {}
+    try:
+        if _index is not current:
+            return _index  # another thread loaded it while this one waited
+        collections = _load_index(db or firestore.Client())
+        if not collections:
+            logging.warning(f"No value index stored in '{INDEX_COLLECTION}'; run `python value_index.py` to build it.")
+        _set_index(collections)
+    except Exception as e:
+        # Keep serving the previous copy and retry after another TTL.
+        logging.error(f"Failed to load the value index: {e}")
+        if current is None:
+            _set_index({})
+        else:
+            with _index_lock:
+                _loaded_at = time.monotonic()
+    finally:
+        _refresh_lock.release()
+    return _index or {}
+
+
+# --- 4. Plan Resolution ---
+_RESOLVABLE_OPERATORS = {"==", "!=", "in", "not-in"}
+_EXCLUSION_OPERATORS = {"!=", "not-in"}
+
+
+def _resolve_conditions(collection: str, conditions: list[dict], index: dict, repairs: list[str]) -> list[dict]:
+    fields = index.get(collection, {})
+    resolved = []
+    for condition in conditions:
+        field_index = fields.get(condition["field"])
+        if field_index is None or condition["operator"] not in _RESOLVABLE_OPERATORS:
+            resolved.append(condition)
+            continue
+        # A wrong guess in an exclusion filter silently keeps the rows the
+        # user wanted gone, so those only get exact/normalized matches.
+        resolve = field_index.resolve_exact if condition["operator"] in _EXCLUSION_OPERATORS else field_index.resolve
+        values = condition["value"] if isinstance(condition["value"], list) else [condition["value"]]
+        snapped = []
+        for value in values:
+            match = resolve(value) if isinstance(value, str) else None
+            if match is not None and match != value:
+                repairs.append(f"value '{value}' for '{condition['field']}' -> '{match}'")
+            snapped.append(match if match is not None else value)
+        value = snapped if isinstance(condition["value"], list) else snapped[0]
+        resolved.append({**condition, "value": value})
+    return resolved
+
+
+def resolve_plan_values(plan: dict, db=None) -> tuple[dict, list[str]]:
+    """
+    Snaps where-clause values of a validated plan (including its join side and
+    in-memory filters) to canonical stored values. Returns the new plan and
+    a list of the substitutions made.
+    """
+    index = get_value_index(db)
+    repairs: list[str] = []
+    if not index:
+        return plan, repairs
+
+    def resolve_side(side: dict) -> dict:
+        side = {**side, "where": _resolve_conditions(side["collection"], side["where"], index, repairs)}
+        if side.get("in_memory", {}).get("where"):
+            side["in_memory"] = {
+                **side["in_memory"],
+                "where": _resolve_conditions(side["collection"], side["in_memory"]["where"], index, repairs),
+            }
+        return side
+
+    plan = resolve_side(plan)
+    if plan.get("join"):
+        plan["join"] = resolve_side(plan["join"])
+    for repair in repairs:
+        logging.info(f"Query plan value resolution: {repair}")
+    return plan, repairs
+
+
+# --- 5. Command-Line Entry Point ---
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    index = build_value_index(firestore.Client())
+    print({collection: {field: len(values) for field, values in fields.items()} for collection, fields in index.items()})